@@ -1,16 +1,25 @@
 import argparse
+import asyncio
 import getpass
 import os
-import re
 import subprocess
 import sys
-from multiprocessing import cpu_count, Pool
+import time
 
 import colorful
 import pkg_resources
 
-from blueteam.backends import LocalBackend, SSHBackend
+from blueteam.backends import Backend, LocalBackend, SSHBackend
+from blueteam.baseline import BaselineStore
+from blueteam.checkpoint import Checkpoint
+from blueteam.fleet import scan_fleet
+from blueteam.indicators import load_rules
+from blueteam.inventory import Target, parse_shard, select, targets_from
 from blueteam.modules import Host
+from blueteam.profile import FleetProfile, Profile, instrument
+from blueteam.rarity import Rarity
+from blueteam.report import ColorRenderer, NDJSONWriter, RESULTS, read_results, status
+from blueteam.watch import Watcher
 
 
 def get_version():
@@ -24,57 +33,112 @@ def get_version():
             return ''
 
 
-def handle_run(host: str, args, sudo=None, key_pass=None):
-    r = re.split(r'((\w+)@)?([.\w]+)(:(\d+))?', host)
-    b = SSHBackend(host=r[3], user=r[2], port=r[5] or 22, keyfile=args.keyfile, sudo=sudo, passphrase=key_pass)
+def connect(target: Target, args, sudo=None, key_pass=None):
+    keyfile = target.keyfile or args.keyfile
+    return SSHBackend(host=target.host, user=target.user, port=target.port or 22,
+                      keyfile=os.path.expanduser(keyfile) if keyfile else None, sudo=sudo,
+                      passphrase=key_pass, timeout=args.connect_timeout)
+
+
+def handle_run(b: Backend, args):
+    b.command_timeout = args.command_timeout or None
+    profile = None
+    if args.fleet_profile:
+        profile = Profile(b.host)
+        instrument(b, profile)
+        args.fleet_profile.add(profile)
+    start = time.perf_counter()
     h = Host(b, cron=not args.no_cron, debsums=not args.skip_debsums,
              pkg=not args.no_pkg, kthreads=not args.no_kthread,
-             file_sentry=args.file_sentry)
+             file_sentry=args.file_sentry, emit=args.emit, profile=profile,
+             indicators=not args.no_indicators, rules=args.rules, checkpoint=args.checkpoint)
     if args.ps:
-        h.get_processes()
+        h.run_task(h.get_processes)
+        # Only for the socket counts in the tree; connections aren't reported in this mode.
+        h.run_task(h.get_connections)
+        h.emit_results(h.get_processes)
     else:
         h.run_all()
-    del h.backend.ssh
+    if profile:
+        profile.total = time.perf_counter() - start
+        profile.snapshot = h.snapshot.stats()
     return h
 
 
-def handle_results(host: Host):
-    print(colorful.white_on_green("RESULTS FOR " + str(host)))
-    if host.sudo:
-        print(colorful.white_on_blue("SUDO FOR " + str(host)))
-        for s in host.sudo:
-            print(s)
-    if host.cron:
-        print(colorful.white_on_blue("CRON FOR " + str(host)))
-        for c in host.cron:
-            print(c)
-    if host.debsums:
-        print(colorful.white_on_blue("DEBSUMS FOR " + str(host)))
-        for d in host.debsums:
-            print(d)
-    if host.users:
-        print(colorful.white_on_blue("LOGIN USERS FOR " + str(host)))
-        for user in host.users:
-            print(colorful.red(user))
-    if host.processes:
-        print(colorful.white_on_blue("PSTREE FOR " + str(host)))
-        host.pstree()
-    if host.connections:
-        print(colorful.white_on_blue("NETWORK FOR " + str(host)))
-        templ = "%-5s %-50s %-50s %-13s %-6s %s"
-        print(templ % (
-            "Proto", "Local address", "Remote address", "Status", "PID",
-            "Program name"))
-        for line in sorted(host.connections):
-            if '127.0.0.1' in line or '::1:' in line:
-                line = colorful.green(line)
-            elif '0.0.0.0' in line or ':::' in line:
-                line = colorful.yellow(line)
-            print(line)
-    if host.files:
-        print(colorful.white_on_blue("FILE SENTRY FOR " + str(host)))
-        for f in sorted(host.files):
-            print(f)
+async def run_hosts(args, sudo=None, key_pass=None):
+    targets = []
+    for target in args.hosts:
+        records = args.checkpoint.done(target.host) if args.checkpoint else None
+        if records is None:
+            targets.append(target)
+            status(colorful.black_on_white("STARTING {}".format(target)))
+            continue
+        status(colorful.black_on_white("ALREADY DONE {}".format(target)))
+        if args.emit:
+            for record in records:
+                args.emit(record)
+            args.emit({'host': records[0]['host'], 'task': 'host', 'status': 'done', 'attempts': 0})
+        if args.rarity:
+            args.rarity.add(records[0]['host'], records)
+    async for result in scan_fleet(targets,
+                                   lambda host: connect(host, args, sudo, key_pass),
+                                   lambda b: handle_run(b, args),
+                                   concurrency=args.concurrency, timeout=args.timeout,
+                                   retries=args.retries):
+        if result.error:
+            status(colorful.white_on_red("FAILED {} after {} attempt(s): {!r}".format(
+                result.target, result.attempts, result.error)))
+            if args.emit:
+                args.emit({'host': result.target.host, 'task': 'host', 'status': 'failed',
+                           'error': repr(result.error), 'attempts': result.attempts})
+        else:
+            if args.emit:
+                args.emit({'host': str(result.host), 'task': 'host', 'status': 'done',
+                           'attempts': result.attempts})
+            records = handle_results(result.host, args)
+            if args.checkpoint and result.host.complete:
+                args.checkpoint.finish(str(result.host), records)
+    report_rarity(args)
+
+
+def merge_results(args):
+    for host, (state, records) in read_results(args.merge).items():
+        if args.emit:
+            for record in records.values():
+                args.emit(record)
+            if state:
+                args.emit({'host': host, 'task': 'host', 'status': state})
+        if records:
+            report_records(host, list(records.values()), args)
+    report_rarity(args)
+
+
+def report_rarity(args):
+    if args.rarity:
+        record = args.rarity.record()
+        if args.emit:
+            args.emit(record)
+        if args.output != 'ndjson':
+            ColorRenderer().render(record)
+
+
+def report_records(host: str, records, args=None):
+    if not args or args.output != 'ndjson':
+        renderer = ColorRenderer(pkg=not args.no_pkg if args else True)
+        if args and args.diff:
+            renderer.diff(host, [args.store.diff(r) for r in records])
+        else:
+            renderer.host(host, records)
+    if args and args.baseline:
+        args.store.save(host, records)
+    if args and args.rarity:
+        args.rarity.add(host, records)
+
+
+def handle_results(host: Host, args=None):
+    records = host.records()
+    report_records(str(host), records, args)
+    return records
 
 
 def cli():
@@ -89,51 +153,150 @@ def cli():
     parser.add_argument('-k', '--no-kthread', action='store_true', help="Don't print kthreads in "
                                                                         "process list.")
     parser.add_argument('-p', '--ps', action='store_true', help='Only perform pstree.')
+    parser.add_argument('--no-indicators', action='store_true',
+                        help="Don't scan authorized_keys, shell rc files, histories and systemd units.")
+    parser.add_argument('--rules', help='JSON file of indicator rules to use instead of the built-in ones.')
     parser.add_argument('-a', '--passphrase', action='store_true', help='Prompt for SSH key passphrase.')
     parser.add_argument('-s', '--sudo', action='store_true', help='Prompt for sudo password.')
-    parser.add_argument('-w', '--workers', default=cpu_count() + 1, type=int, dest='processes',
-                        help='Number of processes to use for SSH hosts.')
-    parser.add_argument('hosts', metavar='[user@]host[:port]', nargs='*', help='SSH hosts to run on.')
+    parser.add_argument('-w', '--workers', default=64, type=int, dest='concurrency',
+                        help='Maximum number of SSH hosts to scan at once.')
+    parser.add_argument('--connect-timeout', default=10, type=float,
+                        help='Seconds to wait for each SSH connection attempt.')
+    parser.add_argument('--timeout', default=0, type=float,
+                        help='Overall deadline in seconds for each host (0 for none).')
+    parser.add_argument('--command-timeout', default=0, type=float,
+                        help='Deadline in seconds for each remote command; a task that hits it '
+                             'reports what it collected so far (0 for none).')
+    parser.add_argument('--retries', default=2, type=int,
+                        help='Times to retry a failed SSH connection, with exponential backoff.')
+    parser.add_argument('hosts', metavar='[user@]host[:port]', nargs='*',
+                        help='SSH hosts to run on. Braces ({01..20}, {a,b}) and CIDR networks are expanded.')
+    parser.add_argument('-I', '--inventory', action='append', default=[], metavar='FILE',
+                        help="File of hosts to run on, one per line, each optionally followed by user=, "
+                             "port= and key= overrides. '-' reads stdin. May be repeated.")
+    parser.add_argument('--shard', metavar='i/n',
+                        help='Only scan the i-th of n shares of the hosts. Hosts are split by a stable '
+                             'hash of their name, so n scanners given the same hosts split them between them.')
+    parser.add_argument('--results', metavar='FILE',
+                        help='Also write every record as NDJSON to FILE. Files from several shards or '
+                             'runs can be combined with --merge.')
+    parser.add_argument('--merge', action='append', default=[], metavar='FILE',
+                        help='Report the results in --results files instead of scanning. May be repeated; '
+                             'later files take precedence.')
     parser.add_argument('-i', '--identity', dest='keyfile', help='SSH identity file to use.')
     parser.add_argument('-f', '--file-sentry', action='store_true', help='Run the file sentry.')
+    parser.add_argument('-o', '--output', choices=('color', 'ndjson'), default='color',
+                        help='Report format. ndjson writes one JSON record per host and task '
+                             'as soon as it finishes.')
+    parser.add_argument('--watch', action='store_true',
+                        help='Local only: keep running and report changes as they happen.')
+    parser.add_argument('--interval', default=1.0, type=float,
+                        help='Seconds between process and connection polls in watch mode.')
+    parser.add_argument('--baseline', action='store_true',
+                        help='Save the results of this run as the baseline for each host.')
+    parser.add_argument('--diff', action='store_true',
+                        help='Only report what was added or removed since the saved baseline.')
+    parser.add_argument('--baseline-dir', help='Where baselines are stored. Defaults to '
+                                               '~/.cache/blueteam/baselines.')
+    parser.add_argument('--rarity', nargs='?', const=1, type=int, metavar='N',
+                        help='After a fleet scan, report processes, listeners, cron lines and unowned '
+                             'files seen on at most N hosts (default 1).')
+    parser.add_argument('--checkpoint', metavar='DIR',
+                        help='Save each finished task of each host to DIR, so an interrupted fleet scan '
+                             'can be picked up with --resume.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the hosts and tasks the --checkpoint directory has results for.')
+    parser.add_argument('--profile', nargs='?', const='-', metavar='FILE',
+                        help='Time every task and backend call and print a per-host and fleet '
+                             'breakdown to stderr, also saving it as JSON to FILE if given.')
     args = parser.parse_args()
+    try:
+        targets = targets_from(args.hosts, args.inventory)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    try:
+        args.hosts = select(targets, *parse_shard(args.shard)) if args.shard else select(targets)
+    except ValueError as e:
+        parser.error('--shard: {}'.format(e))
+    # With a shard, this node may have no hosts left, which must not mean scanning the local machine.
+    fleet = bool(targets or args.merge)
+    args.fleet_profile = FleetProfile() if args.profile else None
+    args.rarity = Rarity(args.rarity) if args.rarity and fleet else None
+    if args.watch and fleet:
+        parser.error('--watch only works on the local machine')
+    if args.merge and targets:
+        parser.error('--merge reports saved results and cannot be combined with hosts to scan')
+    if args.resume and not args.checkpoint:
+        parser.error('--resume needs --checkpoint')
+    if args.checkpoint and fleet and not args.ps:
+        args.checkpoint = Checkpoint(args.checkpoint, args.resume)
+    else:
+        args.checkpoint = None
+    if args.rules:
+        try:
+            args.rules = load_rules(args.rules)
+        except (OSError, ValueError) as e:
+            parser.error('--rules: {}'.format(e))
+    args.store = BaselineStore(args.baseline_dir)
+    args.emit = None
+    if args.output == 'ndjson' or args.results:
+        writer = NDJSONWriter() if args.output == 'ndjson' else None
+        results = None
+        if args.results:
+            try:
+                results = NDJSONWriter(open(args.results, 'w'))
+            except OSError as e:
+                parser.error('--results: {}'.format(e))
+
+        def emit(record):
+            # The results file always gets full records, so it can be merged later.
+            if results:
+                results(record)
+            if writer:
+                writer(args.store.diff(record) if args.diff and record['task'] in RESULTS else record)
+        args.emit = emit
 
-    print(colorful.white_on_blue("blueteam " + get_version()))
+    status(colorful.white_on_blue("blueteam " + get_version()))
 
-    if args.hosts:
-        hosts = []
+    if args.merge:
+        try:
+            merge_results(args)
+        except (OSError, ValueError, KeyError) as e:
+            status(colorful.white_on_red("Can't merge results: {}".format(e)))
+            sys.exit(1)
+    elif fleet:
         sudo_pass = None
         key_pass = None
         if args.passphrase:
-            if not args.keyfile:
+            if not args.keyfile and not any(t.keyfile for t in args.hosts):
                 print("Must specify a keyfile!")
                 sys.exit(0)
             key_pass = getpass.getpass("Passphrase for SSH keyfile:")
         if args.sudo:
             sudo_pass = getpass.getpass("[sudo] password for remote host:")
-        with Pool(processes=args.processes) as pool:
-            for host in args.hosts:
-                print(colorful.black_on_white("STARTING " + host))
-                p = pool.apply_async(handle_run, args=(host, args, sudo_pass, key_pass))
-                hosts.append(p)
-            for r in hosts:
-                r.wait()
-                handle_results(r.get())
+        asyncio.run(run_hosts(args, sudo_pass, key_pass))
     else:
         if os.getuid():
-            print(colorful.white_on_red("Must be run as root to do local. Exiting..."))
+            status(colorful.white_on_red("Must be run as root to do local. Exiting..."))
             sys.exit(0)
-        b = LocalBackend()
-        h = Host(b, cron=not args.no_cron, debsums=not args.skip_debsums,
-                 pkg=not args.no_pkg, kthreads=not args.no_kthread,
-                 file_sentry=args.file_sentry)
-        if args.ps:
-            h.get_processes()
+        h = handle_run(LocalBackend(), args)
+        if args.ps and args.output != 'ndjson':
             h.pstree()
-        else:
-            h.run_all()
-            handle_results(h)
-    print(colorful.white_on_green("Done."))
+        elif not args.ps:
+            handle_results(h, args)
+        if args.watch:
+            if args.output == 'ndjson':
+                alert = NDJSONWriter()
+            else:
+                renderer = ColorRenderer(pkg=not args.no_pkg)
+                alert = lambda d: renderer.diff(str(h), [d])
+            try:
+                Watcher(h, alert, args.interval).run()
+            except KeyboardInterrupt:
+                pass
+    if args.fleet_profile:
+        args.fleet_profile.report(args.profile)
+    status(colorful.white_on_green("Done."))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,239 @@
+# Remote helper. Only uses the standard library: SSHBackend sends this file to python3 once
+# per channel and then talks to it over stdin/stdout. Every message is a 4-byte big-endian
+# length followed by zlib-compressed JSON. A response is any number of {"data": ...} frames
+# followed by {"end": true} (with "error" set if the request failed).
+import glob
+import hashlib
+import json
+import os
+import re
+import stat
+import struct
+import sys
+import zlib
+
+HEADER = struct.Struct('>I')
+BATCH = 1000
+READ_BATCH = 1 << 20
+# Longer lines are matched in pieces, so a file without newlines can't exhaust memory.
+MAX_LINE = 1 << 20
+# Most bytes grepped per file, so a file someone keeps appending to can't stall the scan.
+MAX_GREP = 1 << 28
+
+
+def send(out, obj):
+    data = zlib.compress(json.dumps(obj).encode(), 1)
+    out.write(HEADER.pack(len(data)) + data)
+    out.flush()
+
+
+def recv(stream):
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    return json.loads(zlib.decompress(stream.read(HEADER.unpack(header)[0])).decode())
+
+
+def op_getpid():
+    # The sshd process serving this connection, so every command blueteam runs is under it.
+    pid = os.getppid()
+    while pid > 1:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            stat = f.read()
+        if stat[stat.index('(') + 1:stat.rindex(')')].startswith('sshd'):
+            yield pid
+            return
+        pid = int(stat[stat.rindex(')') + 1:].split()[1])
+    yield os.getppid()
+
+
+def op_getuid():
+    yield os.getuid()
+
+
+def op_glob(patterns):
+    yield [p for pattern in patterns for p in glob.glob(pattern)]
+
+
+def op_stat(patterns):
+    result = {}
+    for pattern in patterns:
+        for path in glob.glob(pattern):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            result[path] = [st.st_size, int(st.st_mtime)]
+    yield result
+
+
+def op_realpath(paths):
+    yield [os.path.realpath(p) for p in paths]
+
+
+def op_walk(top):
+    batch = []
+    for entry in os.walk(top):
+        batch.append(entry)
+        if sum(len(e[2]) for e in batch) >= BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def op_walk_files(top):
+    batch = []
+    stack = [top]
+    while stack:
+        root = stack.pop()
+        real_root = os.path.realpath(root).rstrip('/')
+        try:
+            entries = list(os.scandir(root))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        stack.append(entry.path)
+                    continue
+                link = entry.is_symlink()
+            except OSError:
+                continue
+            batch.append([entry.path, os.path.realpath(entry.path) if link else real_root + '/' + entry.name])
+            if len(batch) >= BATCH:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def op_read(patterns):
+    batch, size = {}, 0
+    for pattern in patterns:
+        for path in glob.glob(pattern):
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                continue
+            if os.path.isdir(path):
+                continue
+            batch[path] = data.decode(errors='replace')
+            size += len(data)
+            if size >= READ_BATCH:
+                yield batch
+                batch, size = {}, 0
+    if batch:
+        yield batch
+
+
+def open_regular(path: str):
+    # Files under home directories belong to their users, who can point them at /dev/zero or
+    # make them FIFOs. Only regular files are opened, without following a final symlink and
+    # without blocking on open; returns None for anything else.
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK | os.O_NOFOLLOW)
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        os.close(fd)
+        return None
+    return os.fdopen(fd, 'rb')
+
+
+def grep_file(f, regex: str, prefilter: str = None, max_bytes: int = MAX_GREP):
+    # Yields the lines of binary file f that match regex. Whole blocks are searched for
+    # prefilter (regex if not given), typically a cheap alternation of literals; a hit is
+    # widened to its line and checked against regex, and the search resumes at the next
+    # line, so a prefilter hit spanning lines (\s matches newlines) can't hide another.
+    block_search = re.compile(prefilter or regex, re.M).search
+    line_search = re.compile(regex).search
+    carry = b''
+    read = 0
+    for block in iter(lambda: f.read(min(READ_BATCH, max_bytes - read)), b''):
+        read += len(block)
+        data = carry + block
+        cut = data.rfind(b'\n') + 1
+        if not cut:
+            if len(data) < MAX_LINE:
+                carry = data
+                continue
+            cut = len(data)
+        carry = data[cut:]
+        text = data[:cut].decode(errors='replace')
+        pos = 0
+        while True:
+            m = block_search(text, pos)
+            if not m:
+                break
+            start = text.rfind('\n', 0, m.start()) + 1
+            end = text.find('\n', m.start())
+            end = len(text) if end < 0 else end
+            line = text[start:end]
+            if line_search(line):
+                yield line
+            pos = end + 1
+    if carry:
+        line = carry.decode(errors='replace')
+        if line_search(line):
+            yield line
+
+
+def op_grep(patterns, regex, prefilter=None):
+    # Lines matching regex, read in blocks so only matches leave the host.
+    batch = []
+    for pattern in patterns:
+        for path in glob.glob(pattern):
+            try:
+                f = open_regular(path)
+            except OSError:
+                continue
+            if f is None:
+                continue
+            with f:
+                try:
+                    for line in grep_file(f, regex, prefilter):
+                        batch.append([path, line])
+                        if len(batch) >= BATCH:
+                            yield batch
+                            batch = []
+                except OSError:
+                    continue
+    if batch:
+        yield batch
+
+
+def op_hash(paths):
+    result = {}
+    for path in paths:
+        h = hashlib.md5()
+        try:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+        except OSError:
+            continue
+        result[path] = h.hexdigest()
+    yield result
+
+
+OPS = {name[3:]: f for name, f in globals().items() if name.startswith('op_')}
+
+
+def main():
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    send(stdout, {'agent': 1, 'ops': sorted(OPS)})
+    while True:
+        request = recv(stdin)
+        if request is None:
+            return
+        try:
+            for data in OPS[request.pop('op')](**request):
+                send(stdout, {'data': data})
+        except Exception as e:
+            send(stdout, {'end': True, 'error': repr(e)})
+        else:
+            send(stdout, {'end': True})
+
+
+if __name__ == '__main__':
+    main()
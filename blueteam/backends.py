@@ -1,21 +1,231 @@
-import ast
+import base64
+import functools
+import hashlib
+import json
 import os
+import re
+import select
+import shlex
+import signal
 import socket
 import sys
+import tarfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
 from abc import ABC, abstractmethod
 from glob import glob
-from subprocess import run
+from subprocess import DEVNULL, PIPE, Popen
+from typing import Dict, Iterable, List
 
 import paramiko
 import psutil
 from braceexpand import braceexpand
 
+from blueteam import agent, debsums, procfs
+from blueteam.report import status
+from blueteam.util import cache_path
+
+
+# Collects every process in a single exec. Exe paths, stat's comm and cmdlines are chosen by
+# whoever starts the process, so nothing is delimited: each field is sent after its length.
+# First comes the passwd table (empty if the caller already has it) as "<length>\n<bytes>",
+# then per PID a "pid uid exe-length stat-length cmdline-length\n" header and the three fields.
+# $(... ; echo .) keeps trailing newlines, cmdline's NULs become \001 so a variable can hold
+# it, and LC_ALL=C makes ${#var} count bytes. Processes that exit midway are left out.
+PROC_PASSWD = "p=$(getent passwd 2>/dev/null || cat /etc/passwd; echo .); p=${p%.}; "
+PROC_SNAPSHOT = (
+    "env LC_ALL=C sh -c 'p=; {}printf \"%s\\n%s\" ${{#p}} \"$p\"; "
+    "for d in /proc/[0-9]*; do "
+    "s=$(cat \"$d/stat\" 2>/dev/null; echo .); s=${{s%.}}; [ -n \"$s\" ] || continue; "
+    "e=$(readlink \"$d/exe\" 2>/dev/null; echo .); e=${{e%.}}; e=${{e%?}}; "
+    "c=$(tr \"\\000\" \"\\001\" < \"$d/cmdline\" 2>/dev/null; echo .); c=${{c%.}}; "
+    "u=$(stat -c %u \"$d\" 2>/dev/null); "
+    "printf \"%s %s %s %s %s\\n%s%s%s\" \"${{d#/proc/}}\" \"${{u:--}}\" ${{#e}} ${{#s}} ${{#c}} \"$e\" \"$s\" \"$c\"; "
+    "done'"
+)
+
+# sudo -S reads the password from stdin only when it prompts; with NOPASSWD or cached
+# credentials the password line stays there. Commands that read stdin are started behind a
+# marker line and skip everything up to it, whether or not sudo took the password.
+SKIP_TO_MARKER = "sh -c 'while IFS= read -r l; do [ \"$l\" = \"$1\" ] && exec sh -c \"$0\"; done; exit 1' {} {}"
+
+
+WALK_BATCH = 1000
+
+
+def chunked(items, size: int):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def split_chunks(chunks, sep: bytes = b'\n'):
+    buf = b''
+    for chunk in chunks:
+        *records, buf = (buf + chunk).split(sep)
+        yield from records
+    if buf:
+        yield buf
+
+
+def split_stream(stream, sep: bytes = b'\n', size: int = 65536):
+    return split_chunks(iter(lambda: stream.read(size), b''), sep)
+
+
+class ChunkReader:
+    """File-like read() over an iterator of byte chunks, for parsers that want a file."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = bytearray()
+
+    def read(self, size: int = -1):
+        while size < 0 or len(self.buf) < size:
+            chunk = next(self.chunks, b'')
+            if not chunk:
+                break
+            self.buf += chunk
+        if size < 0:
+            size = len(self.buf)
+        data = bytes(self.buf[:size])
+        del self.buf[:size]
+        return data
+
+    def readline(self):
+        while b'\n' not in self.buf:
+            chunk = next(self.chunks, b'')
+            if not chunk:
+                return self.read()
+            self.buf += chunk
+        return self.read(self.buf.index(b'\n') + 1)
+
+
+class CommandFailed(Exception):
+    """A command failed or stopped before finishing its output, so its results can't be trusted."""
+
+    def __init__(self, command: str, reason: str):
+        super().__init__("{!r} failed: {}".format(command, reason))
+        self.command = command
+        self.reason = reason
+
+
+class CommandTimeout(Exception):
+    """A command ran past its deadline. Output that arrived before it has already been yielded;
+    run_command() keeps it in partial."""
+
+    def __init__(self, command: str, timeout: float, partial=None):
+        super().__init__("{!r} timed out after {}s".format(command, timeout))
+        self.command = command
+        self.timeout = timeout
+        self.partial = partial
+
+
+# debsums exits 0 when everything matches and 2 when it found changed files; anything else,
+# or no trailer at all, is a failed run.
+DEBSUMS = 'sh -c \'debsums -ac; case $? in 0|2) echo "{}";; esac\''.format(debsums.TRAILER)
+
+
+def verified_files(lines, command: str):
+    # (path, package or None) for each "path[\tpackage]" line, raising CommandFailed if the
+    # output stops before debsums.TRAILER.
+    for line in lines:
+        line = line.decode(errors='replace').rstrip('\n')
+        if line == debsums.TRAILER:
+            return
+        path, _, pkg = line.partition('\t')
+        if path:
+            yield path, pkg or None
+    raise CommandFailed(command, 'verifier exited before finishing')
+
+
+def shell_glob(pattern: str):
+    # Escape everything except glob metacharacters so the remote shell expands them.
+    return re.sub(r'([^\w/.*?\[\]-])', r'\\\1', pattern)
+
+
+# /proc/net tables followed by the socket inode -> PID links and, unless the caller
+# already has them, process names, in one exec.
+NET_COMM = "; echo @comm; grep -H \"\" /proc/[0-9]*/comm 2>/dev/null"
+NET_SNAPSHOT = (
+    "sh -c '"
+    "for f in tcp tcp6 udp udp6; do echo \"@$f\"; cat /proc/net/$f 2>/dev/null; done; "
+    "echo @fd; find /proc/[0-9]*/fd -lname \"socket:*\" -printf \"%h %l\\n\" 2>/dev/null{}'"
+)
+
+TCP_STATES = {
+    '01': 'ESTABLISHED', '02': 'SYN_SENT', '03': 'SYN_RECV', '04': 'FIN_WAIT1',
+    '05': 'FIN_WAIT2', '06': 'TIME_WAIT', '07': 'CLOSE', '08': 'CLOSE_WAIT',
+    '09': 'LAST_ACK', '0A': 'LISTEN', '0B': 'CLOSING', '0C': 'NEW_SYN_RECV',
+}
+
+
+@functools.lru_cache(maxsize=65536)
+def decode_address(address: str):
+    ip, port = address.split(':')
+    ip = bytes.fromhex(ip)
+    if len(ip) == 4:
+        ip = socket.inet_ntop(socket.AF_INET, ip[::-1])
+    else:
+        # Four host-endian 32-bit words.
+        ip = socket.inet_ntop(socket.AF_INET6, b''.join(ip[i:i + 4][::-1] for i in range(0, 16, 4)))
+    return ip, int(port, 16)
+
+
+def parse_net_snapshot(lines: List[str], names: Dict[int, str] = None):
+    sockets, inode_pid = [], {}
+    names = {} if names is None else names
+    section = None
+    for line in lines:
+        if line.startswith('@'):
+            section = line[1:]
+        elif section == 'fd':
+            # /proc/<pid>/fd socket:[<inode>]
+            fd, _, target = line.partition(' ')
+            inode_pid.setdefault(target[8:-1], int(fd.split('/')[2]))
+        elif section == 'comm':
+            path, _, name = line.partition(':')
+            names[int(path.split('/')[2])] = name
+        elif section:
+            fields = line.split()
+            if len(fields) < 10 or fields[0] == 'sl':
+                continue
+            sockets.append((section, fields[1], fields[2], fields[3], fields[9]))
+    res = []
+    for proto, local, remote, state, inode in sockets:
+        raddr = decode_address(remote)
+        pid = inode_pid.get(inode)
+        res.append({
+            'proto': proto,
+            'laddr': "%s:%s" % decode_address(local),
+            'raddr': "%s:%s" % raddr if raddr[1] else '',
+            'status': TCP_STATES.get(state, state) if proto.startswith('tcp') else 'NONE',
+            'pid': pid,
+            'program': names.get(pid),
+        })
+    return res
+
 
 class Backend(ABC):
+    # Default deadline in seconds for stream_command(); None waits forever.
+    command_timeout = None
+
     @abstractmethod
     def run_command(self, command: str):
         pass
 
+    def stream_command(self, command: str, timeout: float = None, sep: bytes = b'\n', input: bytes = None):
+        # Yields output records (raw chunks if sep is None) as they arrive. Closing the
+        # generator cancels the command; passing the deadline raises CommandTimeout.
+        for line in self.run_command(command):
+            yield line.encode() if sep is not None else line.encode() + b'\n'
+
     @abstractmethod
     def read_file(self, path: str):
         pass
@@ -25,11 +235,35 @@ class Backend(ABC):
         pass
 
     @abstractmethod
-    def get_processes(self):
+    def stat_files(self, pattern: str):
+        pass
+
+    def iter_files(self, patterns: List[str]):
+        # Yields (path, lines) per file as it is read.
+        for p in patterns:
+            for f in self.glob(p):
+                yield f, self.read_file(f)
+
+    def read_files(self, patterns: List[str]):
+        return dict(self.iter_files(patterns))
+
+    def grep_files(self, patterns: List[str], regex: str, prefilter: str = None):
+        # Yields (path, line) for lines matching the Python regex, without holding whole files.
+        # prefilter is a cheaper regex every matching line also matches; see agent.grep_file.
+        search = re.compile(regex).search
+        for path, lines in self.iter_files(patterns):
+            for line in lines:
+                if search(line):
+                    yield path, line
+
+    @abstractmethod
+    def get_processes(self, users: Dict[int, str] = None, fields: Iterable[str] = None):
+        # fields names what the caller needs beyond pid, ppid and name (see procfs.FIELDS);
+        # backends may return more, and fill what they skip with None.
         pass
 
     @abstractmethod
-    def get_connections(self):
+    def get_connections(self, names: Dict[int, str] = None):
         pass
 
     @abstractmethod
@@ -48,109 +282,451 @@ class Backend(ABC):
     def real_path(self):
         pass
 
+    def real_paths(self, paths: List[str]):
+        return [self.real_path(p) for p in paths]
+
+    def hash_files(self, paths: List[str]):
+        # md5 of each file's lines; backends that can hash the raw bytes do.
+        result = {}
+        for path in paths:
+            lines = self.read_file(path)
+            if lines:
+                result[path] = hashlib.md5('\n'.join(lines).encode(errors='replace')).hexdigest()
+        return result
+
+    def verify_packages(self):
+        return verified_files(self.stream_command(DEBSUMS), 'debsums')
+
+    def walk_files(self, dirname: str):
+        for root, subdirs, files in self.walk(dirname):
+            for batch in chunked([root + '/' + f for f in files], WALK_BATCH):
+                yield from zip(batch, self.real_paths(batch))
+
+
+class AgentUnavailable(Exception):
+    pass
+
+
+class RemoteAgent:
+    """One long-lived blueteam.agent process on the remote host, reached over its own channel."""
+
+    def __init__(self, backend: 'SSHBackend'):
+        with open(agent.__file__, 'rb') as f:
+            source = f.read()
+        self.sudo = backend.sudo
+        self.stdin, self.stdout, _ = backend._exec(
+            "python3 -u -c 'import sys; exec(compile(sys.stdin.buffer.read({}), \"agent\", \"exec\"))' "
+            "2>/dev/null".format(len(source)), reads_stdin=True)
+        self.stdin.write(source)
+        self.stdin.flush()
+        timeout = backend.command_timeout
+        try:
+            hello = self.recv(time.monotonic() + timeout if timeout else None)
+        except (EOFError, ValueError, zlib.error, socket.timeout):
+            hello = None
+        if not hello or 'agent' not in hello:
+            self.close()
+            raise AgentUnavailable()
+
+    def send(self, obj: dict):
+        data = zlib.compress(json.dumps(obj).encode(), 1)
+        self.stdin.write(agent.HEADER.pack(len(data)) + data)
+        self.stdin.flush()
+
+    def recv(self, deadline: float = None):
+        # Raises socket.timeout once the deadline passes.
+        if deadline is None:
+            self.stdout.channel.settimeout(None)
+        else:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout()
+            self.stdout.channel.settimeout(remaining)
+        header = self.stdout.read(agent.HEADER.size)
+        if len(header) < agent.HEADER.size:
+            raise EOFError('agent exited')
+        return json.loads(zlib.decompress(self.stdout.read(agent.HEADER.unpack(header)[0])).decode())
+
+    def request(self, op: str, timeout: float = None, **args):
+        # Past the deadline this raises CommandTimeout, and the agent, now out of step with
+        # the protocol, is discarded by SSHBackend.agent().
+        deadline = time.monotonic() + timeout if timeout else None
+        self.send({'op': op, **args})
+        while True:
+            try:
+                frame = self.recv(deadline)
+            except socket.timeout:
+                raise CommandTimeout('agent ' + op, timeout) from None
+            if frame.get('end'):
+                if frame.get('error'):
+                    raise OSError('remote agent {} failed: {}'.format(op, frame['error']))
+                return
+            yield frame['data']
+
+    def close(self):
+        self.stdin.channel.close()
+
 
 class SSHBackend(Backend):
+    MAX_AGENTS = 4
+
     def __init__(self, host: str, port: int = 22, user: str = 'root', password: str = None,
-                 keyfile: str = None, sudo: str = None, passphrase: str = None):
+                 keyfile: str = None, sudo: str = None, passphrase: str = None, timeout: float = None):
         self.host = host
         self.sudo = sudo
         self.ssh = paramiko.SSHClient()
         self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        timeouts = {'timeout': timeout, 'banner_timeout': timeout, 'auth_timeout': timeout}
         if passphrase:
-            self.ssh.connect(host, port, user, password, key_filename=keyfile, passphrase=passphrase)
+            self.ssh.connect(host, port, user, password, key_filename=keyfile, passphrase=passphrase, **timeouts)
         else:
             try:
-                self.ssh.connect(host, port, user, password, key_filename=keyfile)
+                self.ssh.connect(host, port, user, password, key_filename=keyfile, **timeouts)
             except paramiko.ssh_exception.PasswordRequiredException:
                 print("SSH key is encrypted! Re-run with --passphrase or -a.")
                 sys.exit(0)
         self.uid_name_map = {}
-        self.uid_pid_map = {}
-
-    def get_connections(self):
-        pass
+        self.agents = []
+        self.agents_started = 0
+        self.agent_ok = True
+        self.agent_lock = threading.Condition()
+
+    @contextmanager
+    def agent(self):
+        # Hands out an idle agent, starting one (up to MAX_AGENTS) if none is free. Agents started
+        # before sudo was switched on are discarded. Raises AgentUnavailable without python3.
+        with self.agent_lock:
+            while True:
+                if not self.agent_ok:
+                    raise AgentUnavailable()
+                for a in [a for a in self.agents if a.sudo != self.sudo]:
+                    self.agents.remove(a)
+                    self.agents_started -= 1
+                    a.close()
+                if self.agents:
+                    a = self.agents.pop()
+                    break
+                if self.agents_started < self.MAX_AGENTS:
+                    self.agents_started += 1
+                    a = None
+                    break
+                self.agent_lock.wait()
+        if a is None:
+            try:
+                a = RemoteAgent(self)
+            except Exception:
+                with self.agent_lock:
+                    self.agents_started -= 1
+                    self.agent_ok = False
+                    self.agent_lock.notify_all()
+                raise AgentUnavailable()
+        ok = False
+        try:
+            yield a
+            ok = True
+        finally:
+            with self.agent_lock:
+                # An agent abandoned mid-response is out of sync with the protocol; drop it.
+                if ok:
+                    self.agents.append(a)
+                else:
+                    self.agents_started -= 1
+                    a.close()
+                self.agent_lock.notify()
+
+    def call(self, op: str, **args):
+        with self.agent() as a:
+            return list(a.request(op, self.command_timeout, **args))
+
+    def stream(self, op: str, **args):
+        with self.agent() as a:
+            yield from a.request(op, self.command_timeout, **args)
+
+    def get_connections(self, names: Dict[int, str] = None):
+        lines = self.stream_command(NET_SNAPSHOT.format('' if names else NET_COMM))
+        return parse_net_snapshot((line.decode(errors='replace') for line in lines), names)
 
     def real_path(self, path: str):
-        return self.remote_python('import os; print os.path.realpath("{}")'.format(path))[0]
+        return self.real_paths([path])[0]
 
-    def get_uid_pid_map(self):
-        for line in self.run_command('stat -c "%n %u" /proc/[0-9]*/'):
-            line = line.split()
-            self.uid_pid_map[int(line[0].split('/')[2])] = int(line[1])
+    def real_paths(self, paths: List[str]):
+        if not paths:
+            return []
+        try:
+            return self.call('realpath', paths=paths)[0]
+        except AgentUnavailable:
+            pass
+        data = self.run_command_raw('xargs -0 realpath -mz --', input=b'\0'.join(p.encode() for p in paths))
+        return [p.decode(errors='replace') for p in data.split(b'\0')[:-1]]
 
-    def get_processes(self):
-        results = self.run_command('cat /proc/[0-9]*/stat')
-        self.get_uid_pid_map()
-        for res in results:
+    def walk_files(self, dirname: str):
+        try:
+            for batch in self.stream('walk_files', top=dirname):
+                for path, real in batch:
+                    yield path, real
+            return
+        except AgentUnavailable:
+            pass
+        # Only the walk root is resolved remotely; regular files under it share its real path,
+        # and symlinked files are resolved in batches.
+        reader = ChunkReader(self.stream_command(
+            'sh -c \'realpath -e "$0" && find -H "$0" -mindepth 1 ! -xtype d -printf "%y\\0%P\\0"\' {} 2>/dev/null'.format(
+                shell_glob(dirname)), sep=None))
+        real_root = reader.readline().decode(errors='replace').rstrip('\n').rstrip('/')
+        if not real_root:
+            return
+        links = []
+        records = split_stream(reader, b'\0')
+        for kind, rel in zip(records, records):
+            path = dirname.rstrip('/') + '/' + rel.decode(errors='replace')
+            if kind == b'l':
+                links.append(path)
+                if len(links) >= WALK_BATCH:
+                    yield from zip(links, self.real_paths(links))
+                    links = []
+            else:
+                yield path, real_root + path[len(dirname.rstrip('/')):]
+        yield from zip(links, self.real_paths(links))
+
+    def verify_packages(self):
+        # Runs blueteam.debsums remotely when python3 is available, otherwise falls back to debsums.
+        # The script goes in the command line: stdin may start with the sudo password, which
+        # sudo leaves unread when it doesn't prompt.
+        with open(debsums.__file__, 'rb') as f:
+            source = base64.b64encode(zlib.compress(f.read(), 9)).decode()
+        return verified_files(self.stream_command(
+            'sh -c \'if command -v python3 >/dev/null; then '
+            'exec python3 -c "import base64, zlib; exec(zlib.decompress(base64.b64decode(\\"{}\\")))" '
+            '--cache "$HOME/.cache/blueteam/debsums.json"; '
+            'else {}; fi\''.format(source, DEBSUMS[len("sh -c '"):-1])), 'blueteam.debsums')
+
+    def get_processes(self, users: Dict[int, str] = None, fields: Iterable[str] = None):
+        if users:
+            self.uid_name_map.update(users)
+        reader = ChunkReader(self.stream_command(PROC_SNAPSHOT.format('' if users else PROC_PASSWD), sep=None))
+        for line in self._read_frame(reader, reader.readline()).decode(errors='replace').splitlines():
+            line = line.split(':')
+            if len(line) > 2 and line[2].isdigit():
+                self.uid_name_map[int(line[2])] = line[0]
+        while True:
+            header = reader.readline()
+            if not header:
+                return
             try:
-                r = self._get_process(res)[1]
-            except Exception:
-                continue
-            yield r['pid'], r
-
-    def _get_process(self, stat: str):
-        pid = int(stat.split()[0])
-        try:
-            exe = self.run_command('readlink /proc/{}/exe'.format(pid))[0].rstrip()
-        except IndexError:
-            exe = ''
-        name = stat.split('(')[1].split(')')[0]
-        ppid = int(stat.split(')')[1].split()[1])
-        cmdline = self.read_file('/proc/{}/cmdline'.format(pid))[0].replace('\x00', ' ')
-        data = {'pid': pid, 'name': name, 'ppid': ppid,
-                'exe': exe,
-                'cmdline': cmdline,
+                pid, uid, *sizes = header.split()
+                pid, uid, sizes = int(pid), int(uid) if uid != b'-' else None, [int(n) for n in sizes]
+            except ValueError:
+                raise ValueError('{}: bad process snapshot header {!r}'.format(self.host, header)) from None
+            if len(sizes) != 3:
+                raise ValueError('{}: bad process snapshot header {!r}'.format(self.host, header))
+            exe, stat, cmdline = (self._read_frame(reader, n) for n in sizes)
+            yield pid, self._parse_process(pid, uid, exe, stat, cmdline)
+
+    def _read_frame(self, reader: ChunkReader, size):
+        data = reader.read(int(size))
+        if len(data) < int(size):
+            raise ValueError('{}: process snapshot ended early'.format(self.host))
+        return data
+
+    def _parse_process(self, pid: int, uid: int, exe: bytes, stat: bytes, cmdline: bytes):
+        stat = stat.decode(errors='replace')
+        proc = {'pid': pid,
+                'name': '?',
+                'ppid': None,
+                'exe': exe.decode(errors='replace'),
+                'cmdline': cmdline.rstrip(b'\x01').replace(b'\x01', b' ').decode(errors='replace'),
                 'connections': '',
-                'username': self.user_from_id(self.uid_pid_map[pid])
+                'username': self.uid_name_map.get(uid, str(uid) if uid is not None else None)
                 }
-        return pid, data
-
-    def user_from_id(self, uid: int):
-        if not self.uid_name_map:
-            for line in self.run_command('getent passwd'):
-                line = line.split(':')
-                self.uid_name_map[int(line[2])] = line[0]
-        return self.uid_name_map[uid]
+        try:
+            proc['name'] = stat[stat.index('(') + 1:stat.rindex(')')]
+            proc['ppid'] = int(stat[stat.rindex(')') + 1:].split()[1])
+        except (ValueError, IndexError):
+            # Still reported, as a root of the tree, rather than hidden from the scan.
+            status('{}: could not parse /proc/{}/stat: {!r}'.format(self.host, pid, stat[:200]))
+        return proc
 
     def getpid(self):
-        return int(self.remote_python('import os; print os.getppid()')[0])
+        try:
+            return self.call('getpid')[0]
+        except AgentUnavailable:
+            # The login shell's parent is the sshd process every command of this session runs under.
+            return int(self.run_command('echo $PPID')[0])
 
     def getuid(self):
-        return int(self.remote_python('import os; print os.getuid()')[0])
-
-    def remote_python(self, command: str):
-        python_command = 'python -c "{}"'.format(command.replace('"', '\\"'))
-        return self.run_command(python_command)
+        try:
+            return self.call('getuid')[0]
+        except AgentUnavailable:
+            return int(self.run_command('id -u')[0])
 
     def glob(self, path: str):
+        patterns = list(braceexpand(path))
+        try:
+            return self.call('glob', patterns=patterns)[0]
+        except AgentUnavailable:
+            pass
         result = []
-        for p in braceexpand(path):
-            result += self.remote_python('from glob import glob\nfor line in glob("{}"): print line'.format(p))
+        for p in patterns:
+            result += [line for line in self.run_command(
+                'sh -c \'for f in {}; do [ -e "$f" ] || [ -L "$f" ] && printf "%s\\n" "$f"; done\''.format(
+                    shell_glob(p))) if line]
         return result
 
-    def run_command(self, command: str):
+    def hash_files(self, paths: List[str]):
+        try:
+            return self.call('hash', paths=paths)[0]
+        except AgentUnavailable:
+            pass
+        data = self.run_command_raw('xargs -0 md5sum -z --', input=b'\0'.join(p.encode() for p in paths))
+        return {line[34:].decode(errors='replace'): line[:32].decode() for line in data.split(b'\0') if line}
+
+    def _exec(self, command: str, input: bytes = None, reads_stdin: bool = False):
+        marker = None
+        if self.sudo and not isinstance(self.sudo, bool) and (reads_stdin or input is not None):
+            marker = os.urandom(8).hex()
+            command = SKIP_TO_MARKER.format(shlex.quote(command), marker)
         if self.sudo:
             command = "sudo -S -p '' " + command
         stdin, stdout, stderr = self.ssh.exec_command(command)
         if self.sudo and not isinstance(self.sudo, bool):
             stdin.write(self.sudo + "\n")
+            if marker:
+                stdin.write(marker + "\n")
+            stdin.flush()
+        if input is not None:
+            stdin.write(input)
             stdin.flush()
+            stdin.channel.shutdown_write()
+        return stdin, stdout, stderr
+
+    def stream_command(self, command: str, timeout: float = None, sep: bytes = b'\n', input: bytes = None):
+        timeout = self.command_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout if timeout else None
+        stdin, stdout, stderr = self._exec(command, input)
+        channel = stdout.channel
+
+        def chunks():
+            while True:
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise CommandTimeout(command, timeout)
+                    channel.settimeout(remaining)
+                try:
+                    chunk = channel.recv(65536)
+                except socket.timeout:
+                    raise CommandTimeout(command, timeout) from None
+                if not chunk:
+                    return
+                yield chunk
+
+        try:
+            yield from chunks() if sep is None else split_chunks(chunks(), sep)
+        finally:
+            channel.close()
+
+    def run_command(self, command: str, timeout: float = None):
         res = []
-        for line in stdout.readlines():
-            res.append(line.rstrip())
+        try:
+            for line in self.stream_command(command, timeout):
+                res.append(line.decode(errors='replace').rstrip())
+        except CommandTimeout as e:
+            e.partial = res
+            raise
         return res
 
+    def run_command_raw(self, command: str, input: bytes = None, timeout: float = None):
+        return b''.join(self.stream_command(command, timeout, sep=None, input=input))
+
     def read_file(self, path: str):
         return self.run_command('cat "{}"'.format(path))
 
+    def grep_files(self, patterns: List[str], regex: str, prefilter: str = None):
+        patterns = [p for pattern in patterns for p in braceexpand(pattern)]
+        try:
+            for batch in self.stream('grep', patterns=patterns, regex=regex, prefilter=prefilter):
+                for path, line in batch:
+                    yield path, line
+            return
+        except AgentUnavailable:
+            pass
+        # Without python3 remotely the files are streamed and matched here; as in the agent, only
+        # regular files that aren't symlinks are read, up to agent.MAX_GREP bytes each.
+        quick, search = re.compile(prefilter or regex).search, re.compile(regex).search
+        path = None
+        for line in self.stream_command(
+                'sh -c \'for f in {}; do [ -f "$f" ] && [ ! -L "$f" ] && printf "\\036%s\\n" "$f" && '
+                '{{ head -c {} -- "$f"; echo; }}; done\' 2>/dev/null'.format(' '.join(shell_glob(p) for p in patterns),
+                                                              agent.MAX_GREP)):
+            line = line.decode(errors='replace')
+            if line.startswith('\x1e'):
+                path = line[1:]
+            elif path and quick(line) and search(line):
+                yield path, line
+
+    def stat_files(self, pattern: str):
+        try:
+            return {path: tuple(st) for path, st in
+                    self.call('stat', patterns=list(braceexpand(pattern)))[0].items()}
+        except AgentUnavailable:
+            pass
+        result = {}
+        for p in braceexpand(pattern):
+            for line in self.run_command('stat -c "%s %Y %n" -- {} 2>/dev/null'.format(shell_glob(p))):
+                line = line.split(' ', 2)
+                if len(line) == 3:
+                    result[line[2]] = (int(line[0]), int(line[1]))
+        return result
+
+    def iter_files(self, patterns: List[str]):
+        try:
+            for batch in self.stream('read', patterns=[p for pattern in patterns for p in braceexpand(pattern)]):
+                for path, text in batch.items():
+                    yield path, [line.rstrip() for line in text.splitlines()]
+            return
+        except AgentUnavailable:
+            pass
+        # The archive is unpacked as it arrives, so each file is parsed before the next is sent.
+        paths = [shell_glob(p) for pattern in patterns for p in braceexpand(pattern)]
+        chunks = self.stream_command(
+            'tar -czhPf - --no-recursion --ignore-failed-read -- {} 2>/dev/null'.format(' '.join(paths)), sep=None)
+        try:
+            with tarfile.open(fileobj=ChunkReader(chunks), mode='r|gz') as tar:
+                for member in tar:
+                    if member.isfile():
+                        yield member.name, [line.rstrip() for line in
+                                            tar.extractfile(member).read().decode(errors='replace').splitlines()]
+        except tarfile.ReadError:
+            pass
+        finally:
+            chunks.close()
+
     def walk(self, dir):
-        return ast.literal_eval(self.remote_python('import os; print list(os.walk("{}"))'.format(dir))[0])
+        try:
+            for batch in self.stream('walk', top=dir):
+                for root, dirs, files in batch:
+                    yield root, dirs, files
+            return
+        except AgentUnavailable:
+            pass
+        tree = {dir: ([], [])}
+        records = self.stream_command(
+            'find -H {} -mindepth 1 -printf "%h\\0%f\\0%y%Y\\0" 2>/dev/null'.format(shell_glob(dir)), sep=b'\0')
+        # %y is the entry's own type and %Y its target's, so symlinked dirs are listed but not walked.
+        for parent, name, kind in zip(records, records, records):
+            parent, name = parent.decode(errors='replace'), name.decode(errors='replace')
+            tree.setdefault(parent, ([], []))[0 if kind[1:] == b'd' else 1].append(name)
+            if kind == b'dd':
+                tree.setdefault(parent.rstrip('/') + '/' + name, ([], []))
+        for root, (dirs, files) in tree.items():
+            yield root, dirs, files
 
 
 class LocalBackend(Backend):
-    def __init__(self):
+    def __init__(self, proc_workers: int = None):
         self.host = "localhost"
         self.sudo = False
+        self.proc_workers = proc_workers
 
     def getpid(self):
         return os.getpid()
@@ -158,20 +734,28 @@ class LocalBackend(Backend):
     def getuid(self):
         return os.getuid()
 
-    @staticmethod
-    def get_processes():
-        for proc in psutil.process_iter(attrs=['pid', 'ppid', 'name', 'exe',
-                                               'cmdline', 'terminal', 'connections',
-                                               'username', 'create_time']):
-            yield proc.pid, proc.info
+    def get_processes(self, users: Dict[int, str] = None, fields: Iterable[str] = None):
+        return procfs.read_processes(procfs.DEFAULT_FIELDS if fields is None else fields, users,
+                                     workers=self.proc_workers)
 
     def real_path(self, path: str):
         return os.path.realpath(path)
 
+    def verify_packages(self):
+        # The hashing pool is started from a thread of Host.run_all, where forking isn't safe.
+        try:
+            yield from debsums.verify(cache_path('debsums.json'), context='forkserver')
+        except OSError as e:
+            raise CommandFailed('blueteam.debsums', str(e))
+
+    def walk_files(self, dirname: str):
+        for batch in agent.op_walk_files(dirname):
+            for path, real in batch:
+                yield path, real
+
     # https://github.com/giampaolo/psutil/blob/master/scripts/netstat.py
-    def get_connections(self):
+    def get_connections(self, names: Dict[int, str] = None):
         res = []
-        AD = "-"
         AF_INET6 = getattr(socket, 'AF_INET6', object())
         proto_map = {
             (socket.AF_INET, socket.SOCK_STREAM): 'tcp',
@@ -179,23 +763,18 @@ class LocalBackend(Backend):
             (socket.AF_INET, socket.SOCK_DGRAM): 'udp',
             (AF_INET6, socket.SOCK_DGRAM): 'udp6',
         }
-        templ = "%-5s %-50s %-50s %-13s %-6s %s"
-        proc_names = {}
-        for p in psutil.process_iter(attrs=['pid', 'name']):
-            proc_names[p.info['pid']] = p.info['name']
+        proc_names = names
+        if proc_names is None:
+            proc_names = {p.info['pid']: p.info['name'] for p in psutil.process_iter(attrs=['pid', 'name'])}
         for c in psutil.net_connections(kind='inet'):
-            laddr = "%s:%s" % c.laddr
-            raddr = ""
-            if c.raddr:
-                raddr = "%s:%s" % c.raddr
-            res.append(templ % (
-                proto_map[(c.family, c.type)],
-                laddr,
-                raddr or AD,
-                c.status,
-                c.pid or AD,
-                proc_names.get(c.pid, '?')[:15],
-            ))
+            res.append({
+                'proto': proto_map[(c.family, c.type)],
+                'laddr': "%s:%s" % c.laddr,
+                'raddr': "%s:%s" % c.raddr if c.raddr else '',
+                'status': c.status,
+                'pid': c.pid,
+                'program': proc_names.get(c.pid),
+            })
         return res
 
     def read_file(self, path: str):
@@ -211,8 +790,93 @@ class LocalBackend(Backend):
             result += glob(p)
         return result
 
-    def run_command(self, command: str):
-        return run(command, shell=True, capture_output=True).stdout.decode().split('\n')
+    def stat_files(self, pattern: str):
+        result = {}
+        for path in self.glob(pattern):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            result[path] = (st.st_size, int(st.st_mtime))
+        return result
+
+    def iter_files(self, patterns: List[str]):
+        for pattern in patterns:
+            for path in self.glob(pattern):
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                except OSError:
+                    continue
+                try:
+                    size = os.fstat(fd).st_size
+                    chunks = [os.read(fd, max(size, 65536) + 1)]
+                    while chunks[-1]:
+                        chunks.append(os.read(fd, 65536))
+                except OSError:
+                    continue
+                finally:
+                    os.close(fd)
+                yield path, [line.rstrip() for line in b''.join(chunks).decode(errors='replace').splitlines()]
+
+    def grep_files(self, patterns: List[str], regex: str, prefilter: str = None):
+        for batch in agent.op_grep([p for pattern in patterns for p in braceexpand(pattern)], regex, prefilter):
+            for path, line in batch:
+                yield path, line
+
+    def stream_command(self, command: str, timeout: float = None, sep: bytes = b'\n', input: bytes = None):
+        timeout = self.command_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout if timeout else None
+        p = Popen(command, shell=True, stdin=DEVNULL if input is None else PIPE, stdout=PIPE, stderr=DEVNULL,
+                  start_new_session=True)
+        if input is not None:
+            # Fed from a thread so a command that writes before reading everything can't deadlock.
+            def feed():
+                with p.stdin:
+                    try:
+                        p.stdin.write(input)
+                    except BrokenPipeError:
+                        pass
+            threading.Thread(target=feed, daemon=True).start()
+
+        def chunks():
+            fd = p.stdout.fileno()
+            while True:
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                        raise CommandTimeout(command, timeout)
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    return
+                yield chunk
+
+        try:
+            yield from chunks() if sep is None else split_chunks(chunks(), sep)
+        finally:
+            if p.poll() is None:
+                # The whole process group, so a pipeline's children don't linger.
+                os.killpg(p.pid, signal.SIGKILL)
+            p.wait()
+            p.stdout.close()
+
+    def run_command(self, command: str, timeout: float = None):
+        res = []
+        try:
+            for line in self.stream_command(command, timeout):
+                res.append(line.decode(errors='replace'))
+        except CommandTimeout as e:
+            e.partial = res
+            raise
+        return res
 
     def walk(self, dir):
         return os.walk(dir)
+
+    def hash_files(self, paths: List[str]):
+        result = {}
+        for path in paths:
+            try:
+                result[path] = debsums.md5_file(path)
+            except OSError:
+                continue
+        return result
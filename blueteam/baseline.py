@@ -0,0 +1,78 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+from blueteam.report import RESULTS
+from blueteam.util import cache_path
+
+
+def _connection(c: dict):
+    if c['status'] == 'LISTEN' or not c['raddr']:
+        return '{} listen {} {}'.format(c['proto'], c['laddr'], c['program'])
+    return '{} to {} {}'.format(c['proto'], c['raddr'], c['program'])
+
+
+# How each result is reduced to comparable entries. Volatile fields such as PIDs and
+# ephemeral ports are left out so only meaningful changes show up in a diff.
+NORMALIZERS = {
+    'sudo': lambda data: data,
+    'cron': lambda data: ('{}: {}'.format(c['file'], line) for c in data for line in c['lines'] or ['']),
+    'debsums': lambda data: (d['path'] for d in data),
+    'users': lambda data: data,
+    'indicators': lambda data: ('{}: {}'.format(d['file'], d['line']) for d in data),
+    'processes': lambda data: ('{} {} ({})'.format(p['username'], p['exe'] or '[{}]'.format(p['name']), p['pkg'] or '')
+                               for p in data),
+    'connections': lambda data: (_connection(c) for c in data),
+    'files': lambda data: data,
+}
+
+
+def snapshot(record: dict):
+    entries = sorted(set(NORMALIZERS[record['task']](record['data'] or ())))
+    # One digest per task lets unchanged tasks be skipped without comparing entries.
+    digest = hashlib.blake2b('\n'.join(entries).encode(errors='replace'), digest_size=16).hexdigest()
+    return {'digest': digest, 'entries': entries}
+
+
+def diff(old: dict, new: dict):
+    if old['digest'] == new['digest']:
+        return [], []
+    old_entries, new_entries = set(old['entries']), set(new['entries'])
+    return sorted(new_entries - old_entries), sorted(old_entries - new_entries)
+
+
+class BaselineStore:
+    """Per-host snapshots of normalized results, stored as {task: {digest, sorted entries}}."""
+
+    def __init__(self, directory: str = None):
+        self.directory = directory or os.path.dirname(cache_path('baselines', 'x'))
+        self.loaded = {}
+        self.lock = threading.Lock()
+
+    def path(self, host: str):
+        return os.path.join(self.directory, host + '.json.gz')
+
+    def load(self, host: str):
+        with self.lock:
+            if host not in self.loaded:
+                try:
+                    with gzip.open(self.path(host), 'rt') as f:
+                        self.loaded[host] = json.load(f)
+                except (OSError, ValueError):
+                    self.loaded[host] = {}
+            return self.loaded[host]
+
+    def save(self, host: str, records):
+        os.makedirs(self.directory, exist_ok=True)
+        data = {r['task']: snapshot(r) for r in records if r['task'] in RESULTS}
+        tmp = '{}.{}'.format(self.path(host), os.getpid())
+        with gzip.open(tmp, 'wt') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path(host))
+
+    def diff(self, record: dict):
+        old = self.load(record['host']).get(record['task'], {'digest': None, 'entries': []})
+        added, removed = diff(old, snapshot(record))
+        return {'host': record['host'], 'task': record['task'], 'added': added, 'removed': removed}
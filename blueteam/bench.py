@@ -0,0 +1,92 @@
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from contextlib import redirect_stderr, redirect_stdout
+
+from blueteam.dpkg import IndexCache
+from blueteam.fake import FakeBackend, SystemImage
+from blueteam.modules import Host
+from blueteam.util import cache_path
+
+TASKS = ('get_packages', 'run_debsums', 'get_processes', 'pstree', 'file_sentry', 'run_all')
+
+
+def image_for(scale: int, seed: int = 0):
+    return SystemImage(processes=scale, dpkg=scale, files=scale // 10, cron=max(1, scale // 1000),
+                       sudoers=max(1, scale // 1000), sockets=max(1, scale // 10), seed=seed)
+
+
+def bench_scale(scale: int, latency: float, repeat: int):
+    image = image_for(scale)
+    results = {}
+    for name in TASKS:
+        best = None
+        round_trips = 0
+        for i in range(repeat):
+            # A fresh host and index cache each run so the package index is always built cold.
+            backend = FakeBackend(image, latency=latency, host='bench-{}-{}-{}'.format(scale, name, i))
+            with redirect_stderr(io.StringIO()):
+                host = Host(backend, file_sentry=True, index_cache=IndexCache(cache_path('dpkg', backend.host)))
+                # Each step runs on top of the ones it depends on, which are not timed.
+                if name in ('get_processes', 'pstree', 'file_sentry', 'run_debsums'):
+                    host.get_packages()
+                if name in ('get_processes', 'pstree'):
+                    host.run_debsums()
+                if name == 'pstree':
+                    host.get_processes()
+                start_trips = backend.round_trips
+                start = time.perf_counter()
+                with redirect_stdout(io.StringIO()):
+                    getattr(host, name)()
+                elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+                round_trips = backend.round_trips - start_trips
+        results[name] = {'seconds': round(best, 6), 'round_trips': round_trips}
+    return results
+
+
+def compare(current: dict, previous: dict):
+    print("{:>8} {:14} {:>10} {:>10} {:>8}".format('scale', 'task', 'before', 'after', 'ratio'))
+    for scale, tasks in current.items():
+        for name, r in tasks.items():
+            old = previous.get(scale, {}).get(name)
+            if old:
+                print("{:>8} {:14} {:>10.4f} {:>10.4f} {:>7.2f}x".format(
+                    scale, name, old['seconds'], r['seconds'], old['seconds'] / max(r['seconds'], 1e-9)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Host tasks against a synthetic system.')
+    parser.add_argument('-s', '--scale', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Number of processes, dpkg entries and files to generate.')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help='Simulated seconds per remote round trip.')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs per task; the fastest is kept.')
+    parser.add_argument('-o', '--output', help='Save results as JSON.')
+    parser.add_argument('-c', '--compare', help='Previous results JSON to compare against.')
+    args = parser.parse_args()
+
+    # Keep the package index cache away from real scan caches.
+    with tempfile.TemporaryDirectory() as cache:
+        os.environ['XDG_CACHE_HOME'] = cache
+        results = {}
+        for scale in args.scale:
+            results[str(scale)] = bench_scale(scale, args.latency, args.repeat)
+            for name, r in results[str(scale)].items():
+                print("{:>8} {:14} {:10.4f}s {:6} round trips".format(scale, name, r['seconds'], r['round_trips']))
+            sys.stdout.flush()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'latency': args.latency, 'results': results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import json
+import os
+import shutil
+import threading
+
+DONE = 'done'
+
+
+class Checkpoint:
+    """Results of each finished task, one JSON file per host and task, so an interrupted scan can resume.
+
+    Files are written to a temporary name and renamed into place, so a scan killed mid-write
+    leaves either the old file or none. Once a host is complete its task files are replaced by
+    the host's records. Tasks are saved as their Host.record() dicts: the scanner usually runs
+    as root, and unlike a pickle, a file planted in the directory can't run code when loaded.
+    """
+
+    def __init__(self, directory: str, resume: bool = False):
+        self.directory = directory
+        self.resume = resume
+        self.started = set()
+        self.lock = threading.Lock()
+
+    def path(self, host: str, name: str = None):
+        return os.path.join(self.directory, host, name + '.json') if name else os.path.join(self.directory, host)
+
+    def _write(self, path: str, data):
+        tmp = '{}.{}.{}'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def _read(self, path: str):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def start(self, host: str):
+        # Without resume, whatever an earlier run left for this host is stale.
+        with self.lock:
+            if host in self.started:
+                return
+            self.started.add(host)
+        if not self.resume:
+            shutil.rmtree(self.path(host), ignore_errors=True)
+        os.makedirs(self.path(host), exist_ok=True)
+
+    def load(self, host: str):
+        # task name -> {result: record} for each task this host already finished.
+        self.start(host)
+        if not self.resume:
+            return {}
+        tasks = {}
+        for entry in os.scandir(self.path(host)):
+            name, ext = os.path.splitext(entry.name)
+            if ext == '.json' and name != DONE:
+                data = self._read(entry.path)
+                if data is not None:
+                    tasks[name] = data
+        return tasks
+
+    def save(self, host: str, task: str, data: dict):
+        self.start(host)
+        self._write(self.path(host, task), data)
+
+    def finish(self, host: str, records):
+        self.start(host)
+        self._write(self.path(host, DONE), records)
+        for entry in os.scandir(self.path(host)):
+            if entry.name != DONE + '.json':
+                os.remove(entry.path)
+
+    def done(self, host: str):
+        # The records of a host finished by an earlier run, or None.
+        return self._read(self.path(host, DONE)) if self.resume else None
@@ -0,0 +1,144 @@
+# Standalone package verifier. Only uses the standard library so SSHBackend can
+# pipe this file to a remote python3 and read mismatches back as they are found.
+import argparse
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import stat
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+INFO_DIR = '/var/lib/dpkg/info'
+STATUS = '/var/lib/dpkg/status'
+MMAP_THRESHOLD = 1 << 20
+BATCH = 256
+# Last line of a complete run. Paths are absolute, so it can't be mistaken for one; output
+# without it means the verifier died, which must not read as "nothing modified".
+TRAILER = 'debsums: done'
+
+
+def expected_sums(info_dir: str = INFO_DIR, status: str = STATUS):
+    sums = {}
+    for name in os.listdir(info_dir):
+        if not name.endswith('.md5sums'):
+            continue
+        pkg = name[:-len('.md5sums')].split(':')[0]
+        try:
+            with open(os.path.join(info_dir, name), 'rb') as f:
+                for line in f:
+                    md5, _, path = line.rstrip(b'\n').partition(b'  ')
+                    if path:
+                        sums['/' + path.decode(errors='surrogateescape')] = (md5.decode(), pkg)
+        except OSError:
+            continue
+    # Conffiles are not in the md5sums files; debsums -a reads them from the status file.
+    pkg, conffiles = None, False
+    try:
+        with open(status, errors='surrogateescape') as f:
+            for line in f:
+                if line.startswith('Package:'):
+                    pkg = line.split(':', 1)[1].strip()
+                elif line.startswith('Conffiles:'):
+                    conffiles = True
+                elif conffiles and line.startswith(' '):
+                    parts = line.split()
+                    if len(parts) >= 2 and len(parts[1]) == 32 and parts[-1] != 'obsolete':
+                        sums[parts[0]] = (parts[1], pkg)
+                else:
+                    conffiles = False
+    except OSError:
+        pass
+    return sums
+
+
+def md5_file(path: str):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return hashlib.md5(m).hexdigest()
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def check(batch):
+    result = []
+    for path, md5 in batch:
+        try:
+            result.append((path, md5_file(path) == md5))
+        except OSError:
+            continue
+    return result
+
+
+def load_cache(path: str):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path: str, cache: dict):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = '{}.{}'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
+
+
+def verify(cache_file: str = None, workers: int = None, context: str = 'fork'):
+    """Yield (path, package) for every packaged file whose contents do not match dpkg's md5sum.
+
+    Files whose inode, size, mtime, ctime and expected md5 match the cache are not re-hashed.
+    context is the multiprocessing start method of the hashing pool; fork is only safe in a
+    single-threaded process, and the others need this module to be importable.
+    """
+    sums = expected_sums()
+    cache = load_cache(cache_file) if cache_file else {}
+    new_cache = {}
+    todo = {}
+    for path, (md5, pkg) in sums.items():
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        key = [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns, md5]
+        entry = cache.get(path)
+        if entry and entry[:5] == key:
+            new_cache[path] = entry
+            if not entry[5]:
+                yield path, pkg
+        else:
+            todo[path] = key
+    batches = [[]]
+    for path, key in todo.items():
+        if len(batches[-1]) >= BATCH:
+            batches.append([])
+        batches[-1].append((path, key[4]))
+    if todo:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(context)) as pool:
+            for result in pool.map(check, batches):
+                for path, ok in result:
+                    new_cache[path] = todo[path] + [ok]
+                    if not ok:
+                        yield path, sums[path][1]
+    if cache_file:
+        save_cache(cache_file, new_cache)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify installed package files against dpkg md5sums.')
+    parser.add_argument('--cache', help='Cache file of previously verified files.')
+    parser.add_argument('--workers', type=int, help='Number of hashing processes.')
+    args = parser.parse_args()
+    for path, pkg in verify(args.cache, args.workers):
+        sys.stdout.write('{}\t{}\n'.format(path, pkg or ''))
+        sys.stdout.flush()
+    sys.stdout.write(TRAILER + '\n')
+
+
+if __name__ == '__main__':
+    main()
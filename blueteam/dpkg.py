@@ -0,0 +1,256 @@
+import functools
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import urllib.parse
+
+from blueteam.backends import Backend, CommandTimeout, chunked
+from blueteam.util import cache_path
+
+INFO_DIR = '/var/lib/dpkg/info'
+STATUS = '/var/lib/dpkg/status'
+
+CACHE_ENTRIES = 32
+CACHE_BYTES = 1 << 30
+
+# Paths, and the names of the lists, are stored as the bytes os.fsencode() gives, so names that aren't valid UTF-8 (which
+# Python hands us as surrogate escapes, and sqlite refuses as TEXT) can be stored and looked up.
+SCHEMA_VERSION = 2
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS lists (name BLOB PRIMARY KEY, size INTEGER, mtime INTEGER);
+CREATE TABLE IF NOT EXISTS paths (path BLOB, pkg TEXT, list BLOB);
+CREATE INDEX IF NOT EXISTS paths_path ON paths (path);
+CREATE INDEX IF NOT EXISTS paths_list ON paths (list);
+"""
+
+
+def package_from_list(name: str):
+    return os.path.basename(name)[:-len('.list')].split(':')[0]
+
+
+class DpkgIndex:
+    """Path -> package index built from dpkg's *.list files and kept in sqlite between runs."""
+
+    def __init__(self, path: str, readonly: bool = False):
+        self.path = path
+        self.readonly = readonly
+        self._db = None
+        self.lock = threading.Lock()
+        if readonly:
+            # Opened now, so the index keeps working if the cache evicts its file later.
+            self.db
+
+    def __getstate__(self):
+        return {'path': self.path, 'readonly': self.readonly}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state.get('readonly', False))
+
+    @property
+    def db(self):
+        if self._db:
+            return self._db
+        # Host tasks share the index across threads; every query goes through self.lock.
+        if self.readonly:
+            # A missing file raises here instead of being created as an empty index.
+            db = sqlite3.connect('file:{}?mode=ro'.format(urllib.parse.quote(self.path)), uri=True,
+                                 check_same_thread=False)
+            if db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                db.close()
+                raise sqlite3.DatabaseError('{} was built by another version'.format(self.path))
+            self._db = db
+        else:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            if self._db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                # Built by an older version; start over rather than mix path encodings.
+                self._db.executescript('DROP TABLE IF EXISTS paths; DROP TABLE IF EXISTS lists;')
+                self._db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def close(self):
+        with self.lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+    def query(self, sql: str, *args):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def refresh(self, backend: Backend):
+        stats = backend.stat_files(INFO_DIR + '/*.list')
+        known = {os.fsdecode(name): (size, mtime)
+                 for name, size, mtime in self.query('SELECT name, size, mtime FROM lists')}
+        stale = [name for name in known if known[name] != stats.get(name)]
+        changed = [name for name in stats if known.get(name) != stats[name]]
+        timeout = None
+        with self.lock, self.db:
+            for batch in chunked([os.fsencode(name) for name in stale], 500):
+                marks = ','.join('?' * len(batch))
+                self.db.execute('DELETE FROM paths WHERE list IN ({})'.format(marks), batch)
+                self.db.execute('DELETE FROM lists WHERE name IN ({})'.format(marks), batch)
+            # Nothing cached yet: let the remote shell expand the glob instead of sending every name.
+            batches = [[INFO_DIR + '/*.list']] if not known else chunked(changed, 2000)
+            try:
+                for batch in batches:
+                    # Lists are indexed as they arrive rather than after the whole batch.
+                    for name, lines in backend.iter_files(batch):
+                        if name not in stats:
+                            continue
+                        pkg, key = package_from_list(name), os.fsencode(name)
+                        self.db.executemany('INSERT INTO paths VALUES (?, ?, ?)',
+                                            ((os.fsencode(line), pkg, key) for line in lines if line))
+                        self.db.execute('INSERT OR REPLACE INTO lists VALUES (?, ?, ?)', (key, *stats[name]))
+            except CommandTimeout as e:
+                # Every list read so far is complete, so keep them; the next refresh fetches the rest.
+                timeout = e
+        if timeout:
+            raise timeout
+        return self
+
+    def __contains__(self, path: str):
+        return bool(self.query('SELECT 1 FROM paths WHERE path = ? LIMIT 1', os.fsencode(path)))
+
+    def __getitem__(self, path: str):
+        pkgs = sorted({pkg for pkg, in self.query('SELECT pkg FROM paths WHERE path = ?', os.fsencode(path))})
+        if not pkgs:
+            raise KeyError(path)
+        return ', '.join(pkgs)
+
+    def get(self, path: str, default=None):
+        try:
+            return self[path]
+        except KeyError:
+            return default
+
+    def __bool__(self):
+        return bool(self.query('SELECT 1 FROM paths LIMIT 1'))
+
+    def __len__(self):
+        return self.query('SELECT COUNT(*) FROM paths')[0][0]
+
+
+class IndexCache:
+    """DpkgIndexes shared by every host with the same installed packages.
+
+    Entries are keyed by the md5 of /var/lib/dpkg/status, so identical hosts cost one index
+    build and then one hash each. A host whose packages changed starts from its previous
+    index and only re-reads the changed lists. Least recently used entries are evicted
+    beyond max_entries or max_bytes.
+    """
+
+    def __init__(self, directory: str, max_entries: int = CACHE_ENTRIES, max_bytes: int = CACHE_BYTES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.keys = {}
+        self.hits = self.misses = 0
+        try:
+            with open(self.path('hosts', '.json')) as f:
+                self.hosts = json.load(f)
+        except (OSError, ValueError):
+            self.hosts = {}
+
+    def path(self, key: str, ext: str = '.sqlite'):
+        return os.path.join(self.directory, key + ext)
+
+    def key(self, backend: Backend):
+        digest = backend.hash_files([STATUS]).get(STATUS)
+        # Without a status file there is nothing to share; fall back to one entry per host.
+        return 'status-' + digest if digest else 'host-' + re.sub(r'[^\w.-]', '_', backend.host)
+
+    def get(self, backend: Backend):
+        key = self.key(backend)
+        with self.lock:
+            lock = self.keys.setdefault(key, threading.Lock())
+        # Hosts with the same key wait for the first one to build the index, then share it.
+        with lock:
+            path = self.path(key)
+            if key.startswith('status-'):
+                try:
+                    index = DpkgIndex(path, readonly=True)
+                except sqlite3.Error:
+                    # Not cached, evicted by another host, or from another version.
+                    index = None
+                if index is not None:
+                    try:
+                        os.utime(path)
+                    except OSError:
+                        pass
+                    with self.lock:
+                        self.hits += 1
+                        self._remember(backend.host, key)
+                    return index
+            with self.lock:
+                self.misses += 1
+                seed = self.hosts.get(backend.host)
+            tmp = self.path(key, '.sqlite.{}.tmp'.format(threading.get_ident()))
+            # Either file may be evicted by another host at any moment; then the build starts empty.
+            try:
+                if seed and seed != key:
+                    shutil.copyfile(self.path(seed), tmp)
+                else:
+                    os.replace(path, tmp)
+            except FileNotFoundError:
+                pass
+            index = DpkgIndex(tmp)
+            try:
+                index.refresh(backend)
+            except CommandTimeout as e:
+                # Keep what was read under this host's name so the next scan resumes from it.
+                e.partial = self._publish(index, backend.host, 'host-' + re.sub(r'[^\w.-]', '_', backend.host))
+                raise
+            return self._publish(index, backend.host, key)
+
+    def _publish(self, index: 'DpkgIndex', host: str, key: str):
+        index.close()
+        # Open before the rename, so another host's eviction can't remove it from under us.
+        published = DpkgIndex(index.path, readonly=True)
+        os.replace(index.path, self.path(key))
+        published.path = self.path(key)
+        with self.lock:
+            self._remember(host, key)
+            self._evict(key)
+        return published
+
+    def _remember(self, host: str, key: str):
+        if self.hosts.get(host) == key:
+            return
+        self.hosts[host] = key
+        tmp = self.path('hosts', '.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.hosts, f)
+        os.replace(tmp, self.path('hosts', '.json'))
+
+    def _evict(self, keep: str):
+        entries = []
+        for e in os.scandir(self.directory):
+            if e.name.endswith('.sqlite') and e.name != keep + '.sqlite':
+                st = e.stat()
+                entries.append((st.st_mtime, st.st_size, e.path))
+        total = os.path.getsize(self.path(keep))
+        entries.sort(reverse=True)
+        for i, (mtime, size, path) in enumerate(entries):
+            total += size
+            # Indexes handed out are already open, and keep working after their file is unlinked.
+            if i + 1 >= self.max_entries or total > self.max_bytes:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+@functools.lru_cache(maxsize=None)
+def shared_cache(directory: str = None):
+    # One cache per process, so concurrent hosts in a fleet scan share builds.
+    return IndexCache(directory or cache_path('dpkg'))
@@ -0,0 +1,202 @@
+import collections
+import fnmatch
+import os
+import random
+import time
+from typing import Dict, Iterable, List
+
+from braceexpand import braceexpand
+
+from blueteam import debsums
+from blueteam.backends import Backend
+
+USERS = ['root', 'daemon', 'www-data', 'postgres', 'alice', 'bob']
+
+
+class SystemImage:
+    """A generated, deterministic system: packages, files, processes, sockets and config files."""
+
+    def __init__(self, processes: int = 1000, dpkg: int = 10000, files: int = 1000, cron: int = 10,
+                 sudoers: int = 5, sockets: int = 100, tampered: int = 5, seed: int = 0):
+        rng = random.Random(seed)
+        self.files = {}
+        self.links = {'/bin': '/usr/bin', '/sbin': '/usr/sbin'}
+
+        passwd = ['{}:x:{}:{}:{}:/home/{}:/bin/bash'.format(u, i, i, u, u) for i, u in enumerate(USERS)]
+        passwd.append('toor:x:0:0::/root:/bin/bash')
+        self.files['/etc/passwd'] = passwd
+        self.files['/etc/shadow'] = ['{}:{}:19000:0:99999:7:::'.format(
+            line.split(':')[0], '$6$salt$hash' if i % 3 == 0 else '*') for i, line in enumerate(passwd)]
+        self.files['/etc/sudoers'] = ['Defaults env_reset', 'root ALL=(ALL:ALL) ALL']
+        for i in range(sudoers):
+            self.files['/etc/sudoers.d/rule{}'.format(i)] = ['{} ALL=(ALL) NOPASSWD: ALL'.format(rng.choice(USERS))]
+        self.files['/etc/crontab'] = ['17 * * * * root cd / && run-parts --report /etc/cron.hourly']
+        for i in range(cron):
+            self.files['/etc/cron.d/job{}'.format(i)] = ['*/5 * * * * root /usr/local/bin/job{}'.format(i)]
+
+        # Packages own a share of binaries, libraries and config files.
+        self.packages = collections.defaultdict(list)
+        npkgs = max(1, dpkg // 100)
+        owned = []
+        for i in range(dpkg):
+            pkg = 'pkg{}'.format(i % npkgs)
+            kind = rng.random()
+            if kind < 0.1:
+                path = '/usr/bin/{}-{}'.format(pkg, i)
+            elif kind < 0.2:
+                path = '/etc/{}/conf{}'.format(pkg, i)
+            else:
+                path = '/usr/lib/{}/file{}'.format(pkg, i)
+            self.packages[pkg].append(path)
+            owned.append(path)
+            self.files[path] = []
+        for pkg, paths in self.packages.items():
+            self.files['/var/lib/dpkg/info/{}:amd64.list'.format(pkg)] = sorted(
+                {os.path.dirname(p) for p in paths} | set(paths))
+        self.files['/var/lib/dpkg/status'] = [
+            line for pkg in self.packages for line in ('Package: ' + pkg, 'Status: install ok installed',
+                                                       'Version: 1.0', '')]
+        for i in range(files):
+            self.files[rng.choice(['/etc/local/extra{}', '/usr/local/bin/tool{}', '/usr/bin/unowned{}']).format(i)] = []
+        self.tampered = rng.sample(owned, min(tampered, len(owned)))
+
+        self.dirs = collections.defaultdict(lambda: (set(), set()))
+        for path in self.files:
+            parent, name = os.path.split(path)
+            self.dirs[parent][1].add(name)
+            while parent != '/':
+                grand, name = os.path.split(parent)
+                self.dirs[grand][0].add(name)
+                parent = grand
+
+        binaries = [p for p in owned if p.startswith('/usr/bin/')] or ['/usr/bin/true']
+        self.processes = [{'pid': 1, 'ppid': 0, 'name': 'init', 'exe': '/sbin/init', 'cmdline': '/sbin/init',
+                           'username': 'root'},
+                          {'pid': 2, 'ppid': 0, 'name': 'kthreadd', 'exe': '', 'cmdline': '', 'username': 'root'}]
+        user_pids = [1]
+        for pid in range(3, processes + 1):
+            if rng.random() < 0.05:
+                self.processes.append({'pid': pid, 'ppid': 2, 'name': 'kworker/{}'.format(pid), 'exe': '',
+                                       'cmdline': '', 'username': 'root'})
+                continue
+            exe = rng.choice(binaries) if rng.random() < 0.95 else '/tmp/.hidden{}'.format(pid)
+            parent = user_pids[-1] if rng.random() < 0.1 else rng.choice(user_pids)
+            self.processes.append({'pid': pid, 'ppid': parent, 'name': os.path.basename(exe),
+                                   'exe': exe, 'cmdline': '{} --flag {}'.format(exe, pid),
+                                   'username': rng.choice(USERS)})
+            user_pids.append(pid)
+        for p in self.processes:
+            p['connections'] = ''
+        self.pid = user_pids[-1]
+
+        self.sockets = []
+        for i in range(sockets):
+            p = rng.choice(self.processes)
+            listen = rng.random() < 0.2
+            self.sockets.append({'proto': rng.choice(['tcp', 'tcp6', 'udp']),
+                                 'laddr': '0.0.0.0:{}'.format(1024 + i) if listen else '10.0.0.1:{}'.format(30000 + i),
+                                 'raddr': '' if listen else '10.0.{}.{}:443'.format(i // 250 % 250, i % 250),
+                                 'status': 'LISTEN' if listen else 'ESTABLISHED',
+                                 'pid': p['pid'], 'program': p['name']})
+
+
+class FakeBackend(Backend):
+    """Backend over a SystemImage. With latency set, every call that would be a round trip
+    over SSH sleeps that long, so batching changes can be measured without real hosts."""
+
+    def __init__(self, image: SystemImage = None, latency: float = 0.0, host: str = 'fake'):
+        self.image = image or SystemImage()
+        self.latency = latency
+        self.host = host
+        self.sudo = False
+        self.round_trips = 0
+
+    def _round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def run_command(self, command: str):
+        self._round_trip()
+        if 'debsums' in command:
+            return list(self.image.tampered) + [debsums.TRAILER]
+        return []
+
+    def read_file(self, path: str):
+        self._round_trip()
+        return list(self.image.files.get(path, []))
+
+    def _glob(self, pattern: str):
+        result = []
+        for p in braceexpand(pattern):
+            if p in self.image.files or p in self.image.dirs or p in self.image.links:
+                result.append(p)
+            elif any(c in p for c in '*?['):
+                parent = os.path.dirname(p)
+                for d in self._glob(parent) if any(c in parent for c in '*?[') else [parent]:
+                    subdirs, files = self.image.dirs.get(d, ((), ()))
+                    result += sorted(os.path.join(d, n) for n in set(subdirs) | set(files)
+                                     if fnmatch.fnmatch(os.path.join(d, n), p))
+                result += [link for link in self.image.links if fnmatch.fnmatch(link, p)]
+        return result
+
+    def glob(self, pattern: str):
+        self._round_trip()
+        return self._glob(pattern)
+
+    def iter_files(self, patterns: List[str]):
+        self._round_trip()
+        for p in patterns:
+            for f in self._glob(p):
+                if f in self.image.files:
+                    yield f, list(self.image.files[f])
+
+    def stat_files(self, pattern: str):
+        self._round_trip()
+        return {f: (len(self.image.files[f]), 0) for f in self._glob(pattern) if f in self.image.files}
+
+    def get_processes(self, users: Dict[int, str] = None, fields: Iterable[str] = None):
+        self._round_trip()
+        for p in self.image.processes:
+            yield p['pid'], dict(p)
+
+    def get_connections(self, names: Dict[int, str] = None):
+        self._round_trip()
+        return [dict(s) for s in self.image.sockets]
+
+    def getpid(self):
+        self._round_trip()
+        return self.image.pid
+
+    def getuid(self):
+        self._round_trip()
+        return 0
+
+    def _walk(self, top: str):
+        stack = [top]
+        while stack:
+            root = stack.pop()
+            subdirs, files = self.image.dirs.get(self.real_path(root), ((), ()))
+            yield root, sorted(subdirs), sorted(files)
+            stack.extend(root.rstrip('/') + '/' + d for d in subdirs)
+
+    def walk(self, top: str):
+        self._round_trip()
+        return list(self._walk(top))
+
+    def walk_files(self, dirname: str):
+        self._round_trip()
+        for root, subdirs, files in self._walk(dirname):
+            real_root = self.real_path(root).rstrip('/')
+            for f in files:
+                yield root.rstrip('/') + '/' + f, real_root + '/' + f
+
+    def real_path(self, path: str):
+        for link, target in self.image.links.items():
+            if path == link or path.startswith(link + '/'):
+                return target + path[len(link):]
+        return path
+
+    def real_paths(self, paths: List[str]):
+        self._round_trip()
+        return [self.real_path(p) for p in paths]
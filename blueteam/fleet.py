@@ -0,0 +1,87 @@
+import asyncio
+import random
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+import paramiko
+
+from blueteam.inventory import Target
+
+# Errors worth retrying; authentication failures are not going to fix themselves.
+RETRY_ERRORS = (socket.error, socket.timeout, EOFError, paramiko.ssh_exception.NoValidConnectionsError)
+
+
+def _close_backend(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().ssh.close()
+
+
+class ScanResult:
+    def __init__(self, target: Target, host=None, error: BaseException = None, attempts: int = 0):
+        self.target = target
+        self.host = host
+        self.error = error
+        self.attempts = attempts
+
+
+async def _scan_one(loop, executor, semaphore, target: Target, connect: Callable, scan: Callable,
+                    timeout: float, retries: int, backoff: float):
+    async with semaphore:
+        state = ScanResult(target)
+        backend = connecting = None
+
+        async def run():
+            nonlocal backend, connecting
+            while True:
+                state.attempts += 1
+                try:
+                    connecting = executor.submit(connect, target)
+                    backend = await asyncio.wrap_future(connecting)
+                    break
+                except paramiko.AuthenticationException as e:
+                    state.error = e
+                    return state
+                except RETRY_ERRORS + (paramiko.SSHException,) as e:
+                    if state.attempts > retries:
+                        state.error = e
+                        return state
+                await asyncio.sleep(backoff * 2 ** (state.attempts - 1) * random.uniform(0.5, 1.5))
+            try:
+                state.host = await loop.run_in_executor(executor, scan, backend)
+            except Exception as e:
+                state.error = e
+            return state
+
+        try:
+            return await asyncio.wait_for(run(), timeout or None)
+        except asyncio.TimeoutError:
+            state.error = TimeoutError('deadline of {}s exceeded'.format(timeout))
+            return state
+        finally:
+            # Closing the transport also unblocks a worker thread still stuck past the deadline.
+            if backend is not None:
+                backend.ssh.close()
+            elif connecting is not None:
+                # A connect still running past the deadline is closed once it returns.
+                connecting.add_done_callback(_close_backend)
+
+
+async def scan_fleet(targets: List[Target], connect: Callable, scan: Callable, concurrency: int = 64,
+                     timeout: float = None, retries: int = 2, backoff: float = 1.0):
+    """Scan targets from one event loop, yielding a ScanResult for each as soon as it finishes.
+
+    connect(target) and scan(backend) are blocking and run in a thread pool sized to the
+    concurrency limit; only connect is retried.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        tasks = [asyncio.ensure_future(_scan_one(loop, executor, semaphore, target, connect, scan,
+                                                 timeout, retries, backoff))
+                 for target in targets]
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        executor.shutdown(wait=False)
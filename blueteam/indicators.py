@@ -0,0 +1,124 @@
+import fnmatch
+import json
+import re
+from typing import Iterable, List
+
+from braceexpand import braceexpand
+
+# Files where persistence usually hides. HOME_FILES are relative to every account's home.
+SYSTEM_FILES = ('/etc/ld.so.preload', '/etc/profile', '/etc/profile.d/*', '/etc/bash.bashrc', '/etc/zsh/zshrc',
+                '/etc/environment', '/etc/rc.local', '/etc/systemd/system/{,*/}*.{service,timer,path,socket}')
+# Histories change on every command a user runs, so watch mode doesn't rescan on them.
+HISTORY_FILES = ('.bash_history', '.zsh_history', '.sh_history', '.history')
+HOME_FILES = ('.ssh/authorized_keys', '.ssh/authorized_keys2', '.ssh/rc', '.bashrc', '.bash_profile', '.bash_login',
+              '.bash_logout', '.profile', '.zshrc', '.zprofile', '.config/systemd/user/*.{service,timer}',
+              '.config/autostart/*.desktop') + HISTORY_FILES
+
+# name: label reported for a hit. pattern: Python regex searched in each line; it must not
+# define its own named groups. keywords: literal strings of which every matching line contains
+# at least one, so files can be scanned for them first, which is far faster than the patterns.
+# files: optional fnmatch globs limiting the files a rule applies to.
+DEFAULT_RULES = [
+    {'name': 'reverse-shell', 'pattern': r'/dev/(tcp|udp)/|\bn(c|cat|etcat)\b[^|;]*\s-[ec]\s|'
+                                         r'\bsocat\b[^|;]*exec:|\bbash\s+-i\s*[<>]&|\bpty\.spawn\(',
+     'keywords': ['/dev/tcp/', '/dev/udp/', 'nc', 'netcat', 'socat', 'bash', 'pty.spawn']},
+    {'name': 'download-exec', 'pattern': r'\b(curl|wget)\b[^|;]*\|\s*(sudo\s+)?(ba|da|z)?sh\b',
+     'keywords': ['curl', 'wget']},
+    {'name': 'encoded-exec', 'pattern': r'\bbase64\s+(-d|--decode)\b|\beval\s+"?\$\(\s*echo\b|\bpython[23]?\s+-c\s',
+     'keywords': ['base64', 'eval', 'python']},
+    {'name': 'preload', 'pattern': r'\bLD_PRELOAD=', 'keywords': ['LD_PRELOAD=']},
+    {'name': 'preload', 'pattern': r'\S', 'files': ['/etc/ld.so.preload']},
+    {'name': 'tmp-exec', 'pattern': r'(^|[\s;&|=])/(tmp|var/tmp|dev/shm)/\S', 'keywords': ['/tmp/', '/dev/shm/']},
+    {'name': 'history-tamper', 'pattern': r'\b(unset\s+HISTFILE|HISTFILE=/dev/null|HISTSIZE=0|history\s+-c)\b',
+     'keywords': ['HISTFILE', 'HISTSIZE', 'history']},
+    {'name': 'ssh-key', 'pattern': r'\b(ssh-(rsa|ed25519|dss)|ecdsa-sha2-\S+|sk-\S+@openssh\.com)\s',
+     'keywords': ['ssh-', 'ecdsa-', 'sk-'], 'files': ['*/.ssh/authorized_keys*']},
+    {'name': 'forced-command', 'pattern': r'(^|,)\s*(command|environment)=', 'keywords': ['command=', 'environment='],
+     'files': ['*/.ssh/authorized_keys*']},
+    {'name': 'systemd-exec', 'pattern': r'^\s*Exec(Start|StartPre|StartPost|Stop)=', 'keywords': ['Exec'],
+     'files': ['*.service']},
+]
+
+
+def load_rules(path: str):
+    with open(path) as f:
+        rules = json.load(f)
+    for rule in rules:
+        if not isinstance(rule, dict) or 'name' not in rule or 'pattern' not in rule:
+            raise ValueError("{}: every rule needs a name and a pattern".format(path))
+        try:
+            groups = re.compile(rule['pattern']).groupindex
+        except re.error as e:
+            raise ValueError("{}: rule {}: {}".format(path, rule['name'], e))
+        if groups:
+            raise ValueError("{}: rule {} may not use named groups".format(path, rule['name']))
+        if not all(isinstance(k, str) and k for k in rule.get('keywords', ())):
+            raise ValueError("{}: rule {}: keywords must be non-empty strings".format(path, rule['name']))
+    return rules
+
+
+def home_dirs(passwd: Iterable[str]):
+    homes = set()
+    for line in passwd:
+        fields = line.split(':')
+        if len(fields) > 5 and fields[5].startswith('/') and fields[5] != '/':
+            homes.add(fields[5].rstrip('/'))
+    return sorted(homes)
+
+
+def scan_patterns(passwd: Iterable[str]):
+    return list(SYSTEM_FILES) + [home + '/' + f for home in home_dirs(passwd) for f in HOME_FILES]
+
+
+class Matcher:
+    """All rules compiled into one regex.
+
+    Files are scanned for the rules' keywords, one alternation of literals, which the regex
+    engine searches far faster than the patterns themselves; only lines containing a keyword
+    are checked against the alternation of every pattern. Both run on the remote side, so only
+    matching lines are sent back. Here, a regex of one optional lookahead per rule then reports
+    every rule a line matches in one call.
+    """
+
+    def __init__(self, rules: List[dict]):
+        self.rules = rules
+        self.search = re.compile(self._regex(range(len(rules)))).search
+        self.which = re.compile(''.join('(?=(?:.*?(?P<r{}>{}))?)'.format(i, r['pattern'])
+                                        for i, r in enumerate(rules))).match
+
+    def plan(self, patterns: Iterable[str]):
+        # Groups file patterns by the rules that can apply to them, with one filter regex per
+        # group, so a rule limited to one file doesn't let every line of every other file through.
+        groups = {}
+        for pattern in patterns:
+            for p in braceexpand(pattern):
+                rules = tuple(i for i, r in enumerate(self.rules)
+                              if not r.get('files') or any(fnmatch.fnmatch(p, f) for f in r['files']))
+                if rules:
+                    groups.setdefault(rules, []).append(p)
+        return [(self._regex(rules), self._prefilter(rules), paths) for rules, paths in groups.items()]
+
+    def _regex(self, rules):
+        return '|'.join('(?:{})'.format(self.rules[i]['pattern']) for i in rules)
+
+    def _prefilter(self, rules):
+        # A rule without keywords has to be searched for as is.
+        keywords = sorted({k for i in rules for k in self.rules[i].get('keywords', ())}, key=lambda k: (-len(k), k))
+        return '|'.join([re.escape(k) for k in keywords] +
+                        ['(?:{})'.format(self.rules[i]['pattern']) for i in rules if not self.rules[i].get('keywords')])
+
+    def match(self, path: str, line: str):
+        # Rule names that apply to this line of path, without duplicates and in rule order.
+        if not self.search(line):
+            return []
+        names = []
+        for key, value in self.which(line).groupdict().items():
+            if value is None:
+                continue
+            rule = self.rules[int(key[1:])]
+            files = rule.get('files')
+            if files and not any(fnmatch.fnmatch(path, f) for f in files):
+                continue
+            if rule['name'] not in names:
+                names.append(rule['name'])
+        return names
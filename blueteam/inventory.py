@@ -0,0 +1,122 @@
+import hashlib
+import ipaddress
+import re
+import shlex
+import sys
+from typing import Iterable, List
+
+from braceexpand import braceexpand
+
+TARGET = re.compile(r'^(?:(?P<user>[^@\s]+)@)?(?P<host>[^:@\s]+)(?::(?P<port>\d+))?$')
+# Largest network a CIDR target may expand to, so a typo'd /8 doesn't queue 16 million hosts.
+MAX_NETWORK = 1 << 16
+
+
+class Target:
+    """One host to scan, with the SSH settings that override the command line's for it."""
+
+    def __init__(self, host: str, user: str = None, port: int = None, keyfile: str = None):
+        self.host = host
+        self.user = user
+        self.port = int(port) if port else None
+        self.keyfile = keyfile
+
+    def __str__(self):
+        return '{}{}{}'.format(self.user + '@' if self.user else '', self.host,
+                               ':{}'.format(self.port) if self.port else '')
+
+    def __repr__(self):
+        return 'Target({!r})'.format(str(self))
+
+    def shard(self, n: int):
+        # Stable across runs and machines, unlike hash(); only the host name counts, so
+        # the same machine lands in the same shard whatever user or port reaches it.
+        return int.from_bytes(hashlib.blake2b(self.host.encode(), digest_size=8).digest(), 'big') % n
+
+
+def _hosts(host: str):
+    if '/' not in host:
+        return [host]
+    try:
+        network = ipaddress.ip_network(host, strict=False)
+    except ValueError as e:
+        raise ValueError('{}: {}'.format(host, e))
+    if network.num_addresses > MAX_NETWORK:
+        raise ValueError('{}: network larger than {} addresses'.format(host, MAX_NETWORK))
+    return [str(a) for a in network.hosts()] or [str(network.network_address)]
+
+
+def expand(spec: str, user: str = None, port: int = None, keyfile: str = None):
+    """Targets of one [user@]host[:port] spec, expanding braces ({1..20}, {a,b}) and CIDR networks."""
+    targets = []
+    for s in braceexpand(spec):
+        m = TARGET.match(s)
+        if not m:
+            raise ValueError('bad target {!r}'.format(s))
+        for host in _hosts(m.group('host')):
+            targets.append(Target(host, m.group('user') or user, m.group('port') or port, keyfile))
+    return targets
+
+
+def parse_line(line: str):
+    # A target spec followed by optional user=, port= and key= overrides.
+    fields = shlex.split(line, comments=True)
+    if not fields:
+        return []
+    options = {}
+    for field in fields[1:]:
+        name, sep, value = field.partition('=')
+        if not sep or name not in ('user', 'port', 'key'):
+            raise ValueError('bad option {!r}; expected user=, port= or key='.format(field))
+        if name == 'port' and not value.isdigit():
+            raise ValueError('bad port {!r}'.format(value))
+        options[name] = value
+    return expand(fields[0], options.get('user'), options.get('port'), options.get('key'))
+
+
+def read_inventory(path: str):
+    """Targets listed in an inventory file, or stdin for '-'. One target per line, for example:
+
+        web{01..40}.example.com user=deploy
+        10.1.2.0/24 port=2222 key=~/.ssh/lab
+        root@db1:2200  # comments and blank lines are ignored
+    """
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        targets = []
+        for n, line in enumerate(f, 1):
+            try:
+                targets.extend(parse_line(line))
+            except ValueError as e:
+                raise ValueError('{}:{}: {}'.format(path, n, e))
+        return targets
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def select(targets: Iterable[Target], shard: int = 0, shards: int = 1):
+    # Keeps this node's shard of the targets. A host listed more than once is scanned
+    # once, with the settings it was first listed with.
+    seen = set()
+    selected = []
+    for t in targets:
+        if t.host not in seen and t.shard(shards) == shard:
+            seen.add(t.host)
+            selected.append(t)
+    return selected
+
+
+def parse_shard(value: str):
+    # 'i/n' on the command line, counting from 1, to a zero-based (shard, shards).
+    m = re.match(r'^(\d+)/(\d+)$', value)
+    if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise ValueError('expected i/n with 1 <= i <= n, got {!r}'.format(value))
+    return int(m.group(1)) - 1, int(m.group(2))
+
+
+def targets_from(specs: List[str], inventories: List[str]):
+    targets = [t for spec in specs for t in expand(spec)]
+    for path in inventories:
+        targets.extend(read_inventory(path))
+    return targets
@@ -1,28 +1,62 @@
 import collections
-import os
 import re
-import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from multiprocessing import Queue
-from typing import List
+from typing import Callable, List
 
 import colorful
 
-from blueteam.backends import Backend
+from blueteam.backends import Backend, CommandFailed, CommandTimeout, chunked
+from blueteam.checkpoint import Checkpoint
+from blueteam.dpkg import IndexCache, shared_cache
+from blueteam.indicators import DEFAULT_RULES, HISTORY_FILES, HOME_FILES, SYSTEM_FILES, Matcher, scan_patterns
+from blueteam.proctable import ProcessTable
+from blueteam.report import ColorRenderer, RESULTS, status
+from blueteam.snapshot import ScanSnapshot
+
+
+SUDOERS = ('/etc/sudoers{,.d/*}',)
+CRONTABS = ('/etc/cron{tab,.*/*}', '/var/spool/cron/crontabs/*')
+ACCOUNTS = ('/etc/passwd', '/etc/shadow')
+SENTRY_DIRS = ('/etc', '/*bin', '/usr/local/*bin')
+
+
+def task(requires=(), provides=(), watch=(), uses=(), updates=()):
+    # Declares which Host attributes a task reads and fills in, so run_all can schedule it,
+    # and which files it reads, so watch mode knows when to re-run it. A trailing /** watches a tree.
+    # uses names the snapshot datasets it reads, which are fetched again when it is re-run.
+    # updates names results it changes after the task providing them ran; those are only
+    # emitted once it is done.
+    def wrap(f):
+        f.requires = tuple(requires)
+        f.provides = tuple(provides)
+        f.watch = tuple(watch)
+        f.uses = tuple(uses)
+        f.updates = tuple(updates)
+        return f
+    return wrap
 
 
 class Host:
     def __init__(self, backend: Backend, cron: bool = True, debsums: bool = True, pkg: bool = True,
                  kthreads: bool = True, file_sentry: bool = False,
-                 q: Queue = None):
+                 q: Queue = None, emit: Callable[[dict], None] = None, profile=None,
+                 index_cache: IndexCache = None, indicators: bool = True, rules: List[dict] = None,
+                 checkpoint: Checkpoint = None):
         self.backend = backend
+        self.index_cache = index_cache or shared_cache()
         self.sudo = []
         self.cron = []
         self.files = set()
         self.debsums = []
         self.users = []
-        self.processes = {}
+        self.indicators = []
+        self.processes = ProcessTable()
         self.connections = []
         self.dpkg = {}
+        self.snapshot = ScanSnapshot({'accounts': self._load_accounts, 'processes': self._load_processes,
+                                      'sockets': self._load_sockets, 'dpkg': self._load_dpkg})
         self.pid = self.backend.getpid()
         self.uid = self.backend.getuid()
         if not self.backend.sudo and self.uid:
@@ -38,132 +72,120 @@ class Host:
             self._tasks.append(self.parse_cron)
         if file_sentry:
             self._tasks.append(self.file_sentry)
+        if indicators:
+            self._tasks.append(self.scan_indicators)
+        self.matcher = Matcher(rules or DEFAULT_RULES)
         self.q = q
+        self.emit = emit
+        self.profile = profile
         self.pkg = pkg
         self.kthreads = kthreads
+        self.checkpoint = checkpoint
+        # Datasets a command deadline cut short, and whether any task ended up with partial results.
+        self.partial = set()
+        self.complete = True
+        # Results whose task failed outright -> why, reported with them.
+        self.errors = {}
 
     def __str__(self):
         return self.backend.host
 
-    def combine_files(self, *patterns: List[str]):
-        for p in patterns:
-            for f in self.backend.glob(p):
-                for line in self.backend.read_file(f):
-                    line = line.rstrip()
-                    if line and not line.startswith('#'):
-                        yield line
+    def combine_files(self, *patterns: List[str], regex: str = None, prefilter: str = None, paths: bool = False):
+        # With regex, only matching lines are fetched, streamed without reading whole files.
+        if regex:
+            lines = self.backend.grep_files(patterns, regex, prefilter)
+        else:
+            lines = ((f, line) for f, content in self.backend.iter_files(patterns) for line in content)
+        for path, line in lines:
+            line = line.rstrip()
+            if line and not line.startswith('#'):
+                yield (path, line) if paths else line
 
     def _get_login_shells(self):
         return self.backend.read_file('/etc/shells')
 
+    def _load_accounts(self):
+        return self.backend.read_files(ACCOUNTS)
+
+    def _load_processes(self):
+        users = {}
+        for line in self.snapshot.get('accounts').get('/etc/passwd', []):
+            line = line.split(':')
+            if len(line) > 2 and line[2].isdigit():
+                users.setdefault(int(line[2]), line[0])
+        procs = []
+        try:
+            for proc in self.backend.get_processes(users=users):
+                procs.append(proc)
+        except CommandTimeout as e:
+            self._timed_out(e)
+            self.partial.add('processes')
+        return procs
+
+    def _load_sockets(self):
+        return self.backend.get_connections(names={pid: p['name'] for pid, p in self.snapshot.get('processes')}) or []
+
+    def _load_dpkg(self):
+        try:
+            return self.index_cache.get(self.backend)
+        except CommandTimeout as e:
+            self._timed_out(e)
+            self.partial.add('dpkg')
+            return e.partial or {}
+
+    def _timed_out(self, e: CommandTimeout):
+        status(colorful.white_on_red("{}: {}; keeping partial results".format(self, e)))
+
+    @task(provides=('sudo',), watch=SUDOERS)
     def parse_sudo(self):
-        for line in self.combine_files('/etc/sudoers{,.d/*}'):
-            if line.startswith("Defaults"):
-                self.sudo.append(line)
-            else:
-                self.sudo.append(str(colorful.yellow(line)))
+        for line in self.combine_files(*SUDOERS):
+            self.sudo.append(line)
 
+    @task(requires=('dpkg', 'debsums'), provides=('cron',), watch=CRONTABS)
     def parse_cron(self):
-        for f in self.backend.glob('/etc/cron{tab,.*/*}') + self.backend.glob('/var/spool/cron/crontabs/*'):
-            modified = self.debsums and f in [d.split()[0] for d in self.debsums]
+        for f, lines in self.backend.read_files(CRONTABS).items():
+            modified = f in self._modified_files()
             new = self.dpkg and f not in self.dpkg
             if modified or new:
-                color = colorful.orange if modified else colorful.yellow
-                self.cron.append(str(color("{} {} ({}) {}".format(
-                    '=' * 10,
-                    f,
-                    'modified' if modified else 'new',
-                    '=' * 10))))
-                for line in self.backend.read_file(f):
-                    if line and not line.startswith('#'):
-                        self.cron.append(line)
+                self.cron.append({'file': f, 'status': 'modified' if modified else 'new',
+                                  'lines': [line for line in lines if line and not line.startswith('#')]})
 
+    @task(requires=('dpkg',), provides=('debsums',))
     def run_debsums(self):
-        f = os.path.join("/tmp", ".debsums." + self.backend.host)
-        if os.path.exists(f):
-            self.debsums.append("From local cache:")
-            with open(f) as f:
-                for line in f:
-                    self.debsums.append(line.strip())
-                return
+        for path, pkg in self.backend.verify_packages():
+            self.debsums.append({'path': path, 'pkg': pkg or self.get_package_name(path)})
 
-        with open(f, 'w') as f:
-            for line in self.backend.run_command('debsums -ac'):
-                if line:
-                    l = "{} ({})".format(line, str(colorful.cyan(self.get_package_name(line).rstrip())))
-                    self.debsums.append(l)
-                    f.write(l + '\n')
+    def _modified_files(self):
+        return {d['path'] for d in self.debsums}
 
+    @task(requires=('processes',), provides=('connections',), uses=('sockets',), updates=('processes',))
     def get_connections(self):
-        self.connections = self.backend.get_connections()
+        self.connections = list(self.snapshot.get('sockets'))
+        self.processes.set_connections(collections.Counter(c['pid'] for c in self.connections))
 
+    @task(requires=('dpkg', 'debsums'), provides=('processes',), uses=('processes',))
     def get_processes(self):
-        for pid, proc in self.backend.get_processes():
-            pkg = self.get_package_name(proc['exe']) if self.pkg else ''
-            self.processes[pid] = {**proc, 'pkg': pkg,
-                                   'verify': proc['exe'] not in self.debsums}
-
-    @staticmethod
-    def _is_kthread(p):
-        return 2 in (p['pid'], p['ppid'])
-
-    def _print_process(self, pid: int):
-        p = self.processes.get(pid)
-        color = colorful.red if not p['pkg'] and not self._is_kthread(p) else colorful.green
-        if p:
-            print("{:9}{:6}{:6} {:4} {:5}{:30} ".format(
-                (p['username'] or 'unk')[:8] + ('+' if len(p['username'] or 'unk') > 8 else ''),
-                p['pid'], p['ppid'],
-                str(colorful.yellow(int(len(p['connections'])))),
-                str(color('dpkg:' if self.pkg and not self._is_kthread(p) else '')),
-                p['pkg'] or ''), end='')
-        else:
-            print(pid, ">???")
-
-    def _print_cmdline(self, p):
-        cmdline = p['cmdline']
-        if type(cmdline) == list:
-            cmdline = ' '.join(p['cmdline'])
-        print(cmdline[:50] if p['cmdline'] else p['name']
-                                                + '...' if len(cmdline) > 50 else '',
-              "(" + (colorful.white(p['exe']) if p['exe'] else colorful.white_on_red(
-                  'missing')) + ")" if not self._is_kthread(p) else '',
-              colorful.white_on_blue('(blueteam)') if self._is_parent(p['pid']) else '')
-
-    def _is_parent(self, pid: int):
-        pid = int(pid)
-        if not pid:
-            return False
-        if pid == self.pid:
-            return True
-        return self._is_parent(self.processes[pid]['ppid'])
-
-    # Stolen from psutil
-    def _print_tree(self, parent, tree, indent=''):
-        parent = int(parent)
-        try:
-            p = self.processes[parent]
-        except KeyError:
-            pass
-        else:
-            self._print_cmdline(p)
-        if parent not in tree:
-            return
-        if parent == 2:
-            return
-        children = tree[parent][:-1]
-        for child in children:
-            self._print_process(child)
-            sys.stdout.write(indent + "\\_ ")
-            self._print_tree(child, tree, indent + "| ")
-        child = tree[parent][-1]
-        self._print_process(child)
-        sys.stdout.write(indent + "\\_ ")
-        self._print_tree(child, tree, indent + "  ")
+        start = time.monotonic()
+        modified = self._modified_files()
+        # Many processes share an executable, so each is matched to its package once.
+        pkgs = {}
+        for pid, proc in self.snapshot.get('processes'):
+            exe = proc['exe']
+            if exe not in pkgs:
+                pkgs[exe] = self.get_package_name(exe) if self.pkg else ''
+            cmdline = proc['cmdline']
+            if isinstance(cmdline, list):
+                cmdline = ' '.join(cmdline)
+            self.processes.add(pid, proc['ppid'], proc['name'], exe, cmdline or '', proc['username'],
+                               len(proc['connections'] or ()), pkgs[exe], exe not in modified)
+        status(colorful.white_on_black("{} collected {} processes in {:.2f}s".format(
+            self, len(self.processes), time.monotonic() - start)))
 
+    @task(provides=('users',), watch=ACCOUNTS, uses=('accounts',))
     def get_login_users(self):
-        passwd = self.backend.read_file('/etc/passwd')
-        shadow = self.backend.read_file('/etc/shadow')
+        files = self.snapshot.get('accounts')
+        passwd = files.get('/etc/passwd', [])
+        shadow = files.get('/etc/shadow', [])
         for i, line in enumerate(passwd):
             if line:
                 if not line.startswith('root') and re.match(r'^[\w-]+:.:(0:\d+|\d+:0):.*$', line):
@@ -174,11 +196,21 @@ class Host:
                     rest = ':'.join(line.split(":")[2:])
                     self.users.append("{}:{}:{}".format(user, h, rest))
 
+    @task(provides=('indicators',),
+          watch=SYSTEM_FILES + tuple('{/root,/home/*}/' + f for f in HOME_FILES if f not in HISTORY_FILES),
+          uses=('accounts',))
+    def scan_indicators(self):
+        passwd = self.snapshot.get('accounts').get('/etc/passwd', [])
+        for regex, prefilter, patterns in self.matcher.plan(scan_patterns(passwd)):
+            for batch in chunked(patterns, 1000):
+                for path, line in self.combine_files(*batch, regex=regex, prefilter=prefilter, paths=True):
+                    rules = self.matcher.match(path, line)
+                    if rules:
+                        self.indicators.append({'file': path, 'line': line, 'rules': rules})
+
+    @task(provides=('dpkg',), uses=('dpkg',))
     def get_packages(self):
-        for line in self.backend.run_command('dpkg -S \*'):
-            pkg = line.split(':')[0]
-            path = line.split(':')[-1].strip()
-            self.dpkg[path] = pkg
+        self.dpkg = self.snapshot.get('dpkg')
 
     def get_package_name(self, path: str):
         if path:
@@ -195,36 +227,133 @@ class Host:
                     self.dpkg[path] = p
             return p
 
+    def restore(self):
+        # Fills in results the checkpoint already has and returns the tasks still to run.
+        saved = self.checkpoint.load(str(self)) if self.checkpoint else {}
+        # get_connections fills in the process table's socket counts, so it runs again with get_processes.
+        if 'get_processes' not in saved:
+            saved.pop('get_connections', None)
+        pending = []
+        for t in self._tasks:
+            if t.__name__ in saved:
+                for name, record in saved[t.__name__].items():
+                    setattr(self, name, self.from_record(record))
+            else:
+                pending.append(t)
+        if 'get_connections' in saved:
+            # The process table was saved before its socket counts were.
+            self.processes.set_connections(collections.Counter(c['pid'] for c in self.connections))
+        later = {name for t in pending for name in t.updates}
+        for t in self._tasks:
+            if t.__name__ in saved:
+                self.emit_results(t, later)
+        # Tasks whose output is only an input to tasks that are already done need not run.
+        while True:
+            needed = {name for t in pending for name in t.requires}
+            idle = [t for t in pending if not set(t.provides) & (needed | set(RESULTS))]
+            if not idle:
+                return pending
+            pending = [t for t in pending if t not in idle]
+
     def run_all(self):
-        for task in self._tasks:
-            print(colorful.white_on_black(str(self) + " running " + task.__name__))
-            task()
-        print(colorful.green_on_black(str(self) + " is done."))
+        # Run every task as soon as the tasks providing its inputs have finished.
+        pending = self.restore()
+        later = {name for t in pending for name in t.updates}
+        providers = collections.defaultdict(set)
+        for t in pending:
+            for name in t.provides:
+                providers[name].add(t.__name__)
+        deps = {t.__name__: set().union(*(providers[name] for name in t.requires)) for t in pending}
+        done = set()
+        partial = set()
+        running = {}
+        with ThreadPoolExecutor(max_workers=len(self._tasks)) as pool:
+            while pending or running:
+                for t in [t for t in pending if deps[t.__name__] <= done]:
+                    pending.remove(t)
+                    status(colorful.white_on_black(str(self) + " running " + t.__name__))
+                    running[pool.submit(self.run_task, t)] = t
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    complete = f.result()
+                    t = running.pop(f)
+                    done.add(t.__name__)
+                    # Anything built on partial results is partial too, and is not checkpointed.
+                    if not complete or deps[t.__name__] & partial:
+                        partial.add(t.__name__)
+                    elif self.checkpoint and set(t.provides) <= set(RESULTS):
+                        self.checkpoint.save(str(self), t.__name__, {name: self.record(name) for name in t.provides})
+                    self.emit_results(t, later)
+        self.complete = not partial
+        status(colorful.green_on_black(str(self) + " is done."))
+
+    def run_task(self, t):
+        # A command past its deadline ends the task with whatever it had parsed by then.
+        # Returns False if the task's results are partial.
+        try:
+            if not self.profile:
+                t()
+            else:
+                with self.profile.task(t.__name__):
+                    t()
+        except CommandTimeout as e:
+            self._timed_out(e)
+            return False
+        except CommandFailed as e:
+            status(colorful.white_on_red("{}: {}".format(self, e)))
+            for name in t.provides:
+                self.errors[name] = str(e)
+            return False
+        return not self.partial & set(t.uses)
+
+    def rerun(self, t):
+        if t.uses:
+            self.snapshot.invalidate(*t.uses)
+            self.partial.difference_update(t.uses)
+        for name in t.provides:
+            setattr(self, name, type(getattr(self, name))())
+            self.errors.pop(name, None)
+        self.run_task(t)
+
+    def emit_results(self, t, later=()):
+        # later: results another task still has to update, which it emits instead.
+        if self.emit:
+            for name in t.updates + tuple(name for name in t.provides if name not in later):
+                if name in RESULTS:
+                    self.emit(self.record(name))
 
-    # Stolen from psutil
     def pstree(self):
-        tree = collections.defaultdict(list)
-        for pid, p in self.processes.items():
-            try:
-                tree[int(p['ppid'])].append(pid)
-            except ValueError:
-                pass
-        # on systems supporting PID 0, PID 0's parent is usually 0
-        if 0 in tree and 0 in tree[0]:
-            tree[0].remove(0)
-        self._print_tree(min(tree), tree)
-
-    def _check_dir(self, dirname: str):
-        for root, subdirs, files in self.backend.walk(dirname):
-            for file in files:
-                path = root + "/" + file
-                if self.backend.real_path(path) not in self.dpkg:
-                    self.files.add(root + "/" + file)
-            for subdir in subdirs:
-                self._check_dir(dirname + "/" + subdir)
+        ColorRenderer(self.pkg).pstree(self.processes, self.pid)
+
+    def record(self, task: str):
+        data = getattr(self, task)
+        record = {'host': str(self), 'task': task}
+        if task == 'processes':
+            data = data.records()
+            record['blueteam_pid'] = self.pid
+        elif task == 'files':
+            data = sorted(data)
+        record['data'] = data
+        if task in self.errors:
+            record['error'] = self.errors[task]
+        return record
+
+    @staticmethod
+    def from_record(record: dict):
+        # The result a record() was made from.
+        if record['task'] == 'processes':
+            return ProcessTable.from_records(record['data'])
+        if record['task'] == 'files':
+            return set(record['data'])
+        return record['data']
+
+    def records(self):
+        return [self.record(task) for task in RESULTS]
 
+    @task(requires=('dpkg',), provides=('files',), watch=tuple(d + '/**' for d in SENTRY_DIRS))
     def file_sentry(self):
-        dirs = ('/etc', '/*bin', '/usr/local/*bin')
-        for dr in dirs:
+        for dr in SENTRY_DIRS:
             for d in self.backend.glob(dr):
-                self._check_dir(d)
+                for path, real in self.backend.walk_files(d):
+                    if real not in self.dpkg:
+                        self.files.add(path)
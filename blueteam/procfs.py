@@ -0,0 +1,107 @@
+import functools
+import os
+import pwd
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable
+
+# Fields beyond pid, ppid and name that can be asked for. connections lists the process's
+# socket fds, which means a readlink per open fd, so it is only read when asked for.
+FIELDS = ('exe', 'cmdline', 'username', 'connections')
+DEFAULT_FIELDS = ('exe', 'cmdline', 'username')
+
+# Below this many processes a thread pool costs more than it saves. Reads spend most of
+# their time in the kernel with the GIL released, so the pool helps even on one CPU.
+POOL_MIN = 5000
+POOL_WORKERS = 4
+
+
+def read_all(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        chunks = [os.read(fd, 65536)]
+        while len(chunks[-1]) == 65536:
+            chunks.append(os.read(fd, 65536))
+    finally:
+        os.close(fd)
+    return b''.join(chunks)
+
+
+@functools.lru_cache(maxsize=None)
+def username(uid: int):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return str(uid)
+
+
+def read_process(pid: int, fields=frozenset(DEFAULT_FIELDS), users: Dict[int, str] = None, root: str = '/proc'):
+    # Returns None if the process exits while it is being read. Fields we may not read stay None.
+    base = '{}/{}'.format(root, pid)
+    try:
+        stat = read_all(base + '/stat').decode(errors='replace')
+        proc = {'pid': pid,
+                'name': stat[stat.index('(') + 1:stat.rindex(')')],
+                'ppid': int(stat[stat.rindex(')') + 1:].split(None, 2)[1]),
+                'exe': None, 'cmdline': None, 'username': None, 'connections': ''}
+        if 'exe' in fields:
+            try:
+                proc['exe'] = os.readlink(base + '/exe')
+            except FileNotFoundError:
+                # Kernel threads have no executable.
+                proc['exe'] = ''
+            except PermissionError:
+                pass
+        if 'cmdline' in fields:
+            argv = read_all(base + '/cmdline').rstrip(b'\0').split(b'\0')
+            proc['cmdline'] = b' '.join(argv).decode(errors='replace')
+            # stat truncates names to 15 characters; recover the rest from argv[0] as ps does.
+            if len(proc['name']) >= 15:
+                arg0 = os.path.basename(argv[0].decode(errors='replace').split(' ')[0])
+                if arg0.startswith(proc['name']):
+                    proc['name'] = arg0
+        if 'username' in fields:
+            uid = os.stat(base).st_uid
+            proc['username'] = users.get(uid, str(uid)) if users else username(uid)
+        if 'connections' in fields:
+            try:
+                proc['connections'] = [t for t in (_readlink(fd.path) for fd in os.scandir(base + '/fd'))
+                                       if t.startswith('socket:')]
+            except PermissionError:
+                pass
+    except (FileNotFoundError, ProcessLookupError, ValueError):
+        return None
+    return proc
+
+
+def _readlink(path: str):
+    try:
+        return os.readlink(path)
+    except OSError:
+        return ''
+
+
+def _read_many(pids, **kwargs):
+    return [read_process(pid, **kwargs) for pid in pids]
+
+
+def read_processes(fields: Iterable[str] = DEFAULT_FIELDS, users: Dict[int, str] = None, root: str = '/proc',
+                   workers: int = None):
+    """Yields (pid, record) for every process under root, reading only the requested fields.
+
+    With workers unset, hosts with at least POOL_MIN processes are read by a thread pool.
+    """
+    pids = [int(e.name) for e in os.scandir(root) if e.name.isdigit()]
+    kwargs = {'fields': frozenset(fields), 'users': users, 'root': root}
+    if workers is None:
+        workers = POOL_WORKERS if len(pids) >= POOL_MIN else 1
+    if workers > 1:
+        step = -(-len(pids) // workers)
+        with ThreadPoolExecutor(workers) as pool:
+            batches = pool.map(functools.partial(_read_many, **kwargs),
+                               [pids[i:i + step] for i in range(0, len(pids), step)])
+            procs = [p for batch in batches for p in batch]
+    else:
+        procs = (read_process(pid, **kwargs) for pid in pids)
+    for proc in procs:
+        if proc:
+            yield proc['pid'], proc
@@ -0,0 +1,151 @@
+import sys
+from array import array
+from typing import Dict, Iterable
+
+
+def _intern(s):
+    return sys.intern(s) if isinstance(s, str) else s
+
+
+class ProcessTable:
+    """The processes of one host, stored by column.
+
+    PIDs, parents and socket counts live in integer arrays; names, executables, users and
+    packages are interned so the thousands of identical workers on a busy host share one
+    string each. Looking up a PID gives a plain dict, so the table can stand in for the
+    old PID -> dict mapping.
+    """
+
+    __slots__ = ('pids', 'ppids', 'connections', 'verify', 'names', 'exes', 'cmdlines', 'users', 'pkgs',
+                 'rows', '_children')
+
+    def __init__(self):
+        self.pids = array('q')
+        self.ppids = array('q')
+        self.connections = array('l')
+        self.verify = bytearray()
+        self.names = []
+        self.exes = []
+        self.cmdlines = []
+        self.users = []
+        self.pkgs = []
+        self.rows = {}
+        self._children = None
+
+    @classmethod
+    def from_records(cls, records: Iterable[dict]):
+        table = cls()
+        for p in records:
+            table.add(p['pid'], p['ppid'], p['name'], p['exe'], p['cmdline'], p['username'],
+                      p.get('connections') or 0, p.get('pkg'), p.get('verify', True))
+        return table
+
+    def add(self, pid: int, ppid: int, name: str, exe: str, cmdline: str, username: str,
+            connections: int = 0, pkg: str = None, verify: bool = True):
+        if pid in self.rows:
+            raise ValueError("duplicate PID {}".format(pid))
+        self.rows[pid] = len(self.pids)
+        self.pids.append(pid)
+        self.ppids.append(ppid if ppid is not None else -1)
+        self.connections.append(connections)
+        self.verify.append(bool(verify))
+        self.names.append(_intern(name))
+        self.exes.append(_intern(exe))
+        self.cmdlines.append(cmdline)
+        self.users.append(_intern(username))
+        self.pkgs.append(_intern(pkg))
+        self._children = None
+
+    def __len__(self):
+        return len(self.pids)
+
+    def __contains__(self, pid):
+        return pid in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __bool__(self):
+        return bool(self.pids)
+
+    def __getitem__(self, pid: int):
+        i = self.rows[pid]
+        return {'pid': self.pids[i], 'ppid': self.ppids[i], 'name': self.names[i], 'exe': self.exes[i],
+                'cmdline': self.cmdlines[i], 'username': self.users[i], 'connections': self.connections[i],
+                'pkg': self.pkgs[i], 'verify': bool(self.verify[i])}
+
+    def get(self, pid: int, default=None):
+        return self[pid] if pid in self.rows else default
+
+    def keys(self):
+        return self.rows.keys()
+
+    def items(self):
+        for pid in self.rows:
+            yield pid, self[pid]
+
+    def values(self):
+        for pid in self.rows:
+            yield self[pid]
+
+    def ppid(self, pid: int):
+        return self.ppids[self.rows[pid]]
+
+    def is_kthread(self, pid: int):
+        return 2 in (pid, self.ppids[self.rows[pid]])
+
+    def children(self):
+        # ppid -> child PIDs in PID order, rebuilt only after the table changes.
+        if self._children is None:
+            children = {}
+            for pid in sorted(self.rows):
+                ppid = self.ppids[self.rows[pid]]
+                if ppid != pid and ppid in self.rows:
+                    children.setdefault(ppid, []).append(pid)
+            self._children = children
+        return self._children
+
+    def roots(self):
+        # Processes whose parent is missing (or is themselves), in PID order.
+        roots = []
+        for pid in sorted(self.rows):
+            ppid = self.ppids[self.rows[pid]]
+            if ppid == pid or ppid not in self.rows:
+                roots.append(pid)
+        return roots
+
+    def descendants(self, pid: int):
+        children = self.children()
+        found, todo = set(), [pid] if pid in self.rows else []
+        while todo:
+            pid = todo.pop()
+            found.add(pid)
+            todo.extend(children.get(pid, ()))
+        return found
+
+    def set_connections(self, counts: Dict[int, int]):
+        for pid, i in self.rows.items():
+            self.connections[i] = counts.get(pid, 0)
+
+    def records(self):
+        return [self[pid] for pid in sorted(self.rows)]
+
+    def __reduce__(self):
+        # Arrays go across as raw bytes; pickle's memo sends each interned string once.
+        return _restore, (self.pids.tobytes(), self.ppids.tobytes(), self.connections.tobytes(), bytes(self.verify),
+                          self.names, self.exes, self.cmdlines, self.users, self.pkgs)
+
+
+def _restore(pids, ppids, connections, verify, names, exes, cmdlines, users, pkgs):
+    table = ProcessTable()
+    table.pids.frombytes(pids)
+    table.ppids.frombytes(ppids)
+    table.connections.frombytes(connections)
+    table.verify = bytearray(verify)
+    table.names = [_intern(s) for s in names]
+    table.exes = [_intern(s) for s in exes]
+    table.cmdlines = cmdlines
+    table.users = [_intern(s) for s in users]
+    table.pkgs = [_intern(s) for s in pkgs]
+    table.rows = {pid: i for i, pid in enumerate(table.pids)}
+    return table
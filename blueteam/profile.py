@@ -0,0 +1,203 @@
+import collections
+import functools
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from blueteam.backends import Backend
+
+INSTRUMENTED = ('run_command', 'run_command_raw', 'stream_command', 'read_file', 'read_files', 'iter_files',
+                'grep_files', 'stat_files', 'glob', 'walk', 'walk_files', 'real_path', 'real_paths', 'hash_files',
+                'get_processes', 'get_connections', 'verify_packages', 'getpid', 'getuid')
+
+_local = threading.local()
+
+
+def _size(result):
+    # (bytes, lines) of a backend result.
+    if isinstance(result, (bytes, str)):
+        return len(result), result.count(b'\n' if isinstance(result, bytes) else '\n')
+    if isinstance(result, dict):
+        sizes = [_size(v) for v in result.values()]
+        return sum(s[0] for s in sizes), sum(s[1] for s in sizes)
+    if isinstance(result, (list, tuple)):
+        return sum(len(x) if isinstance(x, (bytes, str)) else 0 for x in result), len(result)
+    return 0, 0
+
+
+class Stats:
+    __slots__ = ('calls', 'round_trips', 'seconds', 'bytes', 'lines')
+
+    def __init__(self):
+        self.calls = self.round_trips = self.seconds = self.bytes = self.lines = 0
+
+    def add(self, calls=0, seconds=0.0, nbytes=0, lines=0, round_trips=0):
+        self.calls += calls
+        self.round_trips += round_trips
+        self.seconds += seconds
+        self.bytes += nbytes
+        self.lines += lines
+
+    def merge(self, other):
+        self.add(other.calls, other.seconds, other.bytes, other.lines, other.round_trips)
+
+    def as_dict(self):
+        return {'calls': self.calls, 'round_trips': self.round_trips, 'seconds': round(self.seconds, 6),
+                'bytes': self.bytes, 'lines': self.lines}
+
+
+class Profile:
+    """Wall time, round trips, bytes and lines for one host, by backend call and by task."""
+
+    def __init__(self, host: str):
+        self.host = host
+        self.ops = collections.defaultdict(Stats)
+        self.tasks = collections.defaultdict(Stats)
+        self.total = 0.0
+        self.snapshot = {}
+        self.lock = threading.Lock()
+
+    def record(self, op: str, seconds: float, nbytes: int, lines: int, outer: bool):
+        # Nested calls (read_file -> run_command -> stream_command) are timed, but only the
+        # outermost one is a round trip to the host.
+        with self.lock:
+            self.ops[op].add(1, seconds, nbytes, lines, int(outer))
+            task = getattr(_local, 'task', None)
+            if task and outer:
+                self.tasks[task].add(1, 0.0, nbytes, lines, 1)
+
+    @contextmanager
+    def task(self, name: str):
+        _local.task = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.tasks[name].seconds += time.perf_counter() - start
+            _local.task = None
+
+    @property
+    def round_trips(self):
+        return sum(s.round_trips for s in self.ops.values())
+
+    def as_dict(self):
+        return {'host': self.host, 'seconds': round(self.total, 6), 'round_trips': self.round_trips,
+                'ops': {k: v.as_dict() for k, v in self.ops.items()},
+                'tasks': {k: v.as_dict() for k, v in self.tasks.items()},
+                'snapshot': self.snapshot}
+
+
+def _wrap(profile: Profile, name: str, f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        depth = getattr(_local, 'depth', 0)
+        _local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            result = f(*args, **kwargs)
+        finally:
+            _local.depth = depth
+        if hasattr(result, '__next__'):
+            return _wrap_iter(profile, name, result, time.perf_counter() - start, depth == 0)
+        profile.record(name, time.perf_counter() - start, *_size(result), depth == 0)
+        return result
+    return wrapper
+
+
+def _wrap_iter(profile: Profile, name: str, it, elapsed: float, outer: bool):
+    # Only time spent producing items is charged, not time the consumer spends on them.
+    nbytes = lines = 0
+    depth = getattr(_local, 'depth', 0)
+    while True:
+        _local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            break
+        finally:
+            _local.depth = depth
+            elapsed += time.perf_counter() - start
+        lines += 1
+        if isinstance(item, (bytes, str)):
+            nbytes += len(item)
+        elif isinstance(item, tuple):
+            nbytes += sum(len(x) for x in item if isinstance(x, (bytes, str)))
+        yield item
+    profile.record(name, elapsed, nbytes, lines, outer)
+
+
+def instrument(backend: Backend, profile: Profile):
+    # Wraps methods on this instance only, so uninstrumented backends pay nothing.
+    for name in INSTRUMENTED:
+        f = getattr(backend, name, None)
+        if f is not None:
+            setattr(backend, name, _wrap(profile, name, f))
+    return backend
+
+
+def percentile(values, p: float):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class FleetProfile:
+    def __init__(self):
+        self.hosts = []
+        self.lock = threading.Lock()
+
+    def add(self, profile: Profile):
+        with self.lock:
+            self.hosts.append(profile)
+
+    def as_dict(self):
+        ops = collections.defaultdict(Stats)
+        tasks = collections.defaultdict(Stats)
+        snapshot = collections.defaultdict(collections.Counter)
+        for p in self.hosts:
+            for k, v in p.ops.items():
+                ops[k].merge(v)
+            for k, v in p.tasks.items():
+                tasks[k].merge(v)
+            for k, v in p.snapshot.items():
+                snapshot[k].update(v)
+        seconds = [p.total for p in self.hosts]
+        return {
+            'hosts': [p.as_dict() for p in sorted(self.hosts, key=lambda p: -p.total)],
+            'fleet': {
+                'hosts': len(self.hosts),
+                'round_trips': sum(p.round_trips for p in self.hosts),
+                'seconds': {'p50': percentile(seconds, 50), 'p90': percentile(seconds, 90),
+                            'p99': percentile(seconds, 99), 'max': max(seconds, default=0.0)},
+                'ops': {k: v.as_dict() for k, v in ops.items()},
+                'tasks': {k: v.as_dict() for k, v in tasks.items()},
+                'snapshot': {k: dict(v) for k, v in snapshot.items()},
+            },
+        }
+
+    def report(self, path: str = None, out=None):
+        data = self.as_dict()
+        if path and path != '-':
+            with open(path, 'w') as f:
+                json.dump(data, f, indent=2)
+        out = out or sys.stderr
+        fleet = data['fleet']
+        print("PROFILE: {} host(s), {} round trip(s), seconds p50 {p50:.2f} p90 {p90:.2f} p99 {p99:.2f} "
+              "max {max:.2f}".format(fleet['hosts'], fleet['round_trips'], **fleet['seconds']), file=out)
+        templ = "{:24} {:>8} {:>8} {:>10} {:>12} {:>10}"
+        for title, rows in (('task', fleet['tasks']), ('backend call', fleet['ops'])):
+            print(templ.format(title, 'calls', 'trips', 'seconds', 'bytes', 'lines'), file=out)
+            for name, s in sorted(rows.items(), key=lambda r: -r[1]['seconds']):
+                print(templ.format(name, s['calls'], s['round_trips'], '{:.3f}'.format(s['seconds']), s['bytes'],
+                                   s['lines']), file=out)
+        print(templ.format('snapshot', 'hits', 'misses', '', '', ''), file=out)
+        for name, s in sorted(fleet['snapshot'].items()):
+            print(templ.format(name, s.get('hits', 0), s.get('misses', 0), '', '', ''), file=out)
+        print(templ.format('slowest hosts', '', 'trips', 'seconds', '', ''), file=out)
+        for h in data['hosts'][:10]:
+            print(templ.format(h['host'], '', h['round_trips'], '{:.3f}'.format(h['seconds']), '', ''), file=out)
@@ -0,0 +1,140 @@
+import hashlib
+import os
+from array import array
+from typing import Dict, Iterable, List
+
+# Distinct keys per kind counted exactly before new ones go to the sketch.
+EXACT_KEYS = 100000
+# Rare keys first seen after that, kept with the hosts they were seen on.
+MAX_CANDIDATES = 10000
+SKETCH_WIDTH = 1 << 16
+SKETCH_DEPTH = 4
+
+
+class CountMinSketch:
+    """Approximate counts in fixed memory. Estimates never undercount, so a key whose
+    estimate is at most n was seen at most n times."""
+
+    def __init__(self, width: int = SKETCH_WIDTH, depth: int = SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('l', bytes(8 * width)) for _ in range(depth)]
+        self.salt = os.urandom(8)
+
+    def _cells(self, key: str):
+        digest = hashlib.blake2b(key.encode(errors='replace'), digest_size=4 * self.depth, salt=self.salt).digest()
+        for i in range(self.depth):
+            yield self.rows[i], int.from_bytes(digest[4 * i:4 * i + 4], 'little') % self.width
+
+    def add(self, key: str):
+        # Conservative update: only the smallest cells grow, which keeps overestimates down.
+        cells = list(self._cells(key))
+        count = min(row[i] for row, i in cells) + 1
+        for row, i in cells:
+            if row[i] < count:
+                row[i] = count
+        return count
+
+    def estimate(self, key: str):
+        return min(row[i] for row, i in self._cells(key))
+
+
+class KeyCounter:
+    """Number of hosts each key was seen on, and which hosts while there are few of them."""
+
+    def __init__(self, rare: int, exact_keys: int = EXACT_KEYS, max_candidates: int = MAX_CANDIDATES):
+        self.rare = rare
+        self.exact_keys = exact_keys
+        self.max_candidates = max_candidates
+        self.exact = {}
+        self.sketch = None
+        self.candidates = {}
+        self.dropped = 0
+
+    def add(self, host: str, key: str):
+        entry = self.exact.get(key)
+        if entry is None and len(self.exact) < self.exact_keys:
+            entry = self.exact[key] = [0, []]
+        if entry is not None:
+            entry[0] += 1
+            # Host lists are only needed for keys that may still turn out rare.
+            if entry[1] is not None:
+                entry[1] = entry[1] + [host] if entry[0] <= self.rare else None
+            return
+        if self.sketch is None:
+            self.sketch = CountMinSketch()
+        count = self.sketch.add(key)
+        if count > self.rare:
+            self.candidates.pop(key, None)
+        elif key in self.candidates:
+            self.candidates[key].append(host)
+        elif len(self.candidates) < self.max_candidates:
+            self.candidates[key] = [host]
+        else:
+            self.dropped += 1
+
+    def rare_keys(self):
+        for key, (count, hosts) in self.exact.items():
+            if count <= self.rare:
+                yield key, count, hosts, False
+        for key, hosts in self.candidates.items():
+            count = self.sketch.estimate(key)
+            if count <= self.rare:
+                yield key, count, hosts, True
+
+
+def _processes(data: List[dict]):
+    for p in data:
+        if 2 not in (p['pid'], p['ppid']):
+            yield '{} ({})'.format(p['exe'] or '[{}]'.format(p['name']), p['pkg'] or 'no package')
+
+
+def _listeners(data: List[dict]):
+    for c in data:
+        if c['status'] == 'LISTEN' or (c['proto'].startswith('udp') and not c['raddr']):
+            yield '{}/{} {}'.format(c['proto'], c['laddr'].rsplit(':', 1)[-1], c['program'] or '?')
+
+
+def _cron(data: List[dict]):
+    for c in data:
+        for line in c['lines']:
+            yield line
+
+
+# Result -> kind of key and how its entries are reduced to keys.
+KEYS = {
+    'processes': ('process', _processes),
+    'connections': ('listener', _listeners),
+    'cron': ('cron', _cron),
+    'files': ('unowned file', lambda data: data),
+}
+
+
+class Rarity:
+    """Merges results from every host of a fleet scan and finds what only a few hosts have."""
+
+    def __init__(self, rare: int = 1, exact_keys: int = EXACT_KEYS, max_candidates: int = MAX_CANDIDATES):
+        self.rare = rare
+        self.hosts = 0
+        self.counters = {kind: KeyCounter(rare, exact_keys, max_candidates) for kind, _ in KEYS.values()}
+
+    def add(self, host: str, records: Iterable[dict]):
+        self.hosts += 1
+        for record in records:
+            if record['task'] in KEYS:
+                kind, keys = KEYS[record['task']]
+                counter = self.counters[kind]
+                # Each host counts once per key, however many processes or lines it has.
+                for key in set(keys(record['data'] or ())):
+                    counter.add(host, key)
+
+    def record(self):
+        data = []
+        for kind, counter in self.counters.items():
+            for key, count, hosts, estimated in counter.rare_keys():
+                data.append({'kind': kind, 'key': key, 'count': count, 'hosts': sorted(hosts or ()),
+                             'estimated': estimated})
+        data.sort(key=lambda d: (d['kind'], d['count'], d['key']))
+        dropped: Dict[str, int] = {kind: c.dropped for kind, c in self.counters.items() if c.dropped}
+        return {'host': None, 'task': 'rarity', 'hosts': self.hosts, 'rare': self.rare, 'data': data,
+                'dropped': dropped}
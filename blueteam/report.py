@@ -0,0 +1,196 @@
+import json
+import sys
+import threading
+
+import colorful
+
+from blueteam.proctable import ProcessTable
+
+# Host attributes that are reported, in report order.
+RESULTS = ('sudo', 'cron', 'debsums', 'users', 'indicators', 'processes', 'connections', 'files')
+
+CONNECTION_TEMPLATE = "%-5s %-50s %-50s %-13s %-6s %s"
+
+
+def status(message):
+    # Progress goes to stderr so stdout only carries results.
+    print(message, file=sys.stderr, flush=True)
+
+
+def format_connection(c: dict):
+    return CONNECTION_TEMPLATE % (c['proto'], c['laddr'], c['raddr'] or '-', c['status'],
+                                  c['pid'] or '-', (c['program'] or '?')[:15])
+
+
+class NDJSONWriter:
+    """Writes each record as one JSON line as soon as it is emitted."""
+
+    def __init__(self, out=None):
+        self.out = out or sys.stdout
+        self.lock = threading.Lock()
+
+    def __call__(self, record: dict):
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.out.write(line + '\n')
+            self.out.flush()
+
+
+def read_results(paths):
+    """Merges NDJSON result files, such as those of several scan shards, into
+    host -> [status, {task: record}]. Later records replace earlier ones, so a host
+    scanned again in a later file reports its latest results."""
+    hosts = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record['task'] == 'host':
+                    hosts.setdefault(record['host'], [None, {}])[0] = record['status']
+                # Diffs from --diff can't be merged back into results.
+                elif record['task'] in RESULTS and 'data' in record:
+                    hosts.setdefault(record['host'], [None, {}])[1][record['task']] = record
+    return hosts
+
+
+class ColorRenderer:
+    """Human-readable colored report built from the same records NDJSONWriter emits."""
+
+    def __init__(self, pkg: bool = True, out=None):
+        self.pkg = pkg
+        self.out = out or sys.stdout
+
+    def write(self, *args, end='\n'):
+        print(*args, end=end, file=self.out)
+
+    def host(self, host: str, records):
+        self.write(colorful.white_on_green("RESULTS FOR " + host))
+        records = {r['task']: r for r in records}
+        for task in RESULTS:
+            if task in records:
+                self.render(records[task])
+
+    def diff(self, host: str, diffs):
+        self.write(colorful.white_on_green("CHANGES FOR " + host))
+        for d in diffs:
+            if d['added'] or d['removed']:
+                self.write(colorful.white_on_blue("{} CHANGES FOR {}".format(d['task'].upper(), host)))
+                for line in d['added']:
+                    self.write(colorful.red('+ ' + line))
+                for line in d['removed']:
+                    self.write(colorful.green('- ' + line))
+
+    def render(self, record: dict):
+        if record.get('error'):
+            self.write(colorful.white_on_red("{} FAILED FOR {}: {}".format(
+                record['task'].upper(), record['host'], record['error'])))
+        if record['data']:
+            getattr(self, 'render_' + record['task'])(record)
+
+    def render_sudo(self, record):
+        self.write(colorful.white_on_blue("SUDO FOR " + record['host']))
+        for line in record['data']:
+            self.write(line if line.startswith("Defaults") else colorful.yellow(line))
+
+    def render_cron(self, record):
+        self.write(colorful.white_on_blue("CRON FOR " + record['host']))
+        for c in record['data']:
+            color = colorful.orange if c['status'] == 'modified' else colorful.yellow
+            self.write(color("{} {} ({}) {}".format('=' * 10, c['file'], c['status'], '=' * 10)))
+            for line in c['lines']:
+                self.write(line)
+
+    def render_debsums(self, record):
+        self.write(colorful.white_on_blue("DEBSUMS FOR " + record['host']))
+        for d in record['data']:
+            self.write("{} ({})".format(d['path'], colorful.cyan(d['pkg'] or '')))
+
+    def render_users(self, record):
+        self.write(colorful.white_on_blue("LOGIN USERS FOR " + record['host']))
+        for user in record['data']:
+            self.write(colorful.red(user))
+
+    def render_indicators(self, record):
+        self.write(colorful.white_on_blue("INDICATORS FOR " + record['host']))
+        for d in record['data']:
+            self.write("{}: {} {}".format(d['file'], colorful.red(','.join(d['rules'])), d['line']))
+
+    def render_processes(self, record):
+        self.write(colorful.white_on_blue("PSTREE FOR " + record['host']))
+        self.pstree(ProcessTable.from_records(record['data']), record.get('blueteam_pid'))
+
+    def render_connections(self, record):
+        self.write(colorful.white_on_blue("NETWORK FOR " + record['host']))
+        self.write(CONNECTION_TEMPLATE % (
+            "Proto", "Local address", "Remote address", "Status", "PID",
+            "Program name"))
+        for line in sorted(format_connection(c) for c in record['data']):
+            if '127.0.0.1' in line or '::1:' in line:
+                line = colorful.green(line)
+            elif '0.0.0.0' in line or ':::' in line:
+                line = colorful.yellow(line)
+            self.write(line)
+
+    def render_files(self, record):
+        self.write(colorful.white_on_blue("FILE SENTRY FOR " + record['host']))
+        for f in record['data']:
+            self.write(f)
+
+    def render_rarity(self, record):
+        self.write(colorful.white_on_blue("SEEN ON AT MOST {} OF {} HOSTS".format(record['rare'], record['hosts'])))
+        for r in record['data']:
+            self.write("{} {} {}".format(colorful.cyan(r['kind']), colorful.yellow(r['key']),
+                                         '({}{} host(s): {})'.format('~' if r['estimated'] else '', r['count'],
+                                                                      ', '.join(r['hosts']))))
+        for kind, n in record['dropped'].items():
+            self.write(colorful.orange("{} rare {} key(s) not kept".format(n, kind)))
+
+    @staticmethod
+    def _template(style: str):
+        # Render each style once and reuse it with str.format; colorful is slow per call.
+        return str(getattr(colorful, style)('{}'))
+
+    def pstree(self, processes: ProcessTable, blueteam_pid: int = None):
+        # Processes whose parent is missing (or is themselves) become roots instead of being dropped.
+        children = processes.children()
+        roots = processes.roots()
+        ours = processes.descendants(blueteam_pid)
+        rows = processes.rows
+
+        yellow, red, green = self._template('yellow'), self._template('red'), self._template('green')
+        exe_templ, missing = self._template('white'), self._template('white_on_red').format('missing')
+        ours_mark = ' ' + self._template('white_on_blue').format('(blueteam)')
+        out = []
+        stack = [(pid, '', i == len(roots) - 1) for i, pid in reversed(list(enumerate(roots)))]
+        while stack:
+            pid, indent, last = stack.pop()
+            i = rows[pid]
+            ppid, pkg, exe = processes.ppids[i], processes.pkgs[i], processes.exes[i]
+            kthread = 2 in (pid, ppid)
+            username = processes.users[i] or 'unk'
+            color = red if not pkg and not kthread else green
+            cmdline = processes.cmdlines[i]
+            cmdline = cmdline.replace('\n', ' ') if cmdline else ''
+            line = "{:9}{:6}{:6} {:4} {:5}{:30} {}\\_ {}".format(
+                username[:8] + ('+' if len(username) > 8 else ''),
+                pid, ppid,
+                yellow.format(processes.connections[i]),
+                color.format('dpkg:' if self.pkg and not kthread else ''),
+                pkg or '',
+                indent,
+                cmdline[:50] + ('...' if len(cmdline) > 50 else '') if cmdline else processes.names[i])
+            if not kthread:
+                line += " (" + (exe_templ.format(exe) if exe else missing) + ")"
+            if pid in ours:
+                line += ours_mark
+            out.append(line)
+            if pid == 2:
+                continue
+            kids = children.get(pid)
+            if kids:
+                child_indent = indent + ('  ' if last else '| ')
+                stack.extend((kids[i], child_indent, i == len(kids) - 1) for i in range(len(kids) - 1, -1, -1))
+        if out:
+            self.out.write('\n'.join(out) + '\n')
@@ -0,0 +1,35 @@
+import collections
+import threading
+from typing import Callable, Dict
+
+
+class ScanSnapshot:
+    """Datasets shared by the tasks of one scan, each fetched from the backend on first use."""
+
+    def __init__(self, loaders: Dict[str, Callable[[], object]]):
+        self.loaders = loaders
+        self.data = {}
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        # One lock per dataset, so a task waiting on the process table doesn't block one
+        # reading accounts. Loaders may get() other datasets, as long as there is no cycle.
+        self.locks = {name: threading.Lock() for name in loaders}
+        self.lock = threading.Lock()
+
+    def get(self, name: str):
+        with self.locks[name]:
+            hit = name in self.data
+            with self.lock:
+                (self.hits if hit else self.misses)[name] += 1
+            if not hit:
+                self.data[name] = self.loaders[name]()
+            return self.data[name]
+
+    def invalidate(self, *names: str):
+        for name in names or self.loaders:
+            with self.locks[name]:
+                self.data.pop(name, None)
+
+    def stats(self):
+        with self.lock:
+            return {name: {'hits': self.hits[name], 'misses': self.misses[name]} for name in self.loaders}
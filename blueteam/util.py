@@ -0,0 +1,8 @@
+import os
+
+
+def cache_path(*parts: str):
+    base = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'blueteam')
+    path = os.path.join(base, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
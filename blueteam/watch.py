@@ -0,0 +1,232 @@
+import ctypes
+import ctypes.util
+import fnmatch
+import glob
+import hashlib
+import os
+import select
+import struct
+import time
+from typing import Callable
+
+import colorful
+from braceexpand import braceexpand
+
+from blueteam.baseline import diff, snapshot
+from blueteam.modules import Host
+from blueteam.report import RESULTS, status
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT = struct.Struct('iIII')
+
+PROC_NET = ('/proc/net/tcp', '/proc/net/tcp6', '/proc/net/udp', '/proc/net/udp6')
+
+
+def _dir_parts(pattern: str):
+    return [c for c in os.path.dirname(pattern).split('/') if c]
+
+
+def _is_prefix(path: str, parts):
+    # Whether path is one of the directories a pattern with these directory parts can lie under.
+    names = [c for c in path.split('/') if c]
+    return len(names) <= len(parts) and all(fnmatch.fnmatch(n, p) for n, p in zip(names, parts))
+
+
+class Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.paths = {}
+
+    def add(self, path: str):
+        if path in self.paths.values():
+            return
+        wd = self.libc.inotify_add_watch(self.fd, path.encode(), WATCH_MASK)
+        if wd >= 0:
+            self.paths[wd] = path
+
+    def read(self):
+        # Yields (path, mask); path is None when the kernel queue overflowed.
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0').decode(errors='replace')
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                yield None, mask
+                continue
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            if wd in self.paths:
+                yield os.path.join(self.paths[wd], name) if name else self.paths[wd], mask
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    """Keeps a local Host up to date, re-running only the tasks whose inputs changed.
+
+    File-based tasks are driven by inotify on the paths they declare with @task(watch=...);
+    processes and connections are polled every interval. Each re-run is diffed against the
+    previous result and only additions and removals are passed to alert.
+    """
+
+    def __init__(self, host: Host, alert: Callable[[dict], None], interval: float = 1.0):
+        self.host = host
+        self.alert = alert
+        self.interval = interval
+        self.inotify = Inotify()
+        self.patterns = {}
+        self.trees = {}
+        self.previous = {}
+        self.pids = set()
+        self.net = None
+        self.tasks = {t.__name__: t for t in host._tasks}
+
+    def _watch_tree(self, top: str):
+        for root, dirs, files in os.walk(top):
+            self.inotify.add(root)
+
+    def _watch_dirs(self, parts, root: str = '/'):
+        # Watches every existing directory the pattern can lie under, from root down to the first
+        # missing one, so that creating it (a user's first ~/.ssh) is seen and watched in turn.
+        dirs = [root]
+        for part in parts[len([c for c in root.split('/') if c]):]:
+            for d in dirs:
+                self.inotify.add(d)
+            dirs = [p for d in dirs for p in glob.glob(os.path.join(glob.escape(d), part)) if os.path.isdir(p)]
+        for d in dirs:
+            self.inotify.add(d)
+
+    def setup(self):
+        for name, t in self.tasks.items():
+            for pattern in t.watch:
+                for p in braceexpand(pattern):
+                    if p.endswith('/**'):
+                        for top in glob.glob(p[:-3]):
+                            self.trees.setdefault(name, []).append(os.path.realpath(top))
+                            self._watch_tree(top)
+                        continue
+                    self.patterns.setdefault(name, []).append(p)
+                    self._watch_dirs(_dir_parts(p))
+        for name in self.tasks:
+            for task in self.tasks[name].provides:
+                if task in RESULTS:
+                    self.previous[task] = snapshot(self.host.record(task))
+        self.pids = self._pids()
+        self.net = self._net()
+
+    def affected(self, path: str, directory: bool = False):
+        result = set()
+        for name, patterns in self.patterns.items():
+            if any(fnmatch.fnmatch(path, p) or directory and _is_prefix(path, _dir_parts(p)) for p in patterns):
+                result.add(name)
+        real = os.path.realpath(path)
+        for name, tops in self.trees.items():
+            if any(real == top or real.startswith(top + '/') for top in tops):
+                result.add(name)
+        return result
+
+    @staticmethod
+    def _pids():
+        return {int(p) for p in os.listdir('/proc') if p.isdigit()}
+
+    @staticmethod
+    def _net():
+        h = hashlib.blake2b(digest_size=16)
+        for path in PROC_NET:
+            try:
+                with open(path, 'rb') as f:
+                    # Drop the queue and timer columns, which change on every packet.
+                    for line in f.read().splitlines()[1:]:
+                        fields = line.split()
+                        h.update(b' '.join(fields[1:4] + fields[7:10]))
+            except OSError:
+                continue
+        return h.digest()
+
+    def poll(self):
+        dirty = set()
+        pids = self._pids()
+        if pids - self.pids and 'get_processes' in self.tasks:
+            dirty.add('get_processes')
+        self.pids = pids
+        net = self._net()
+        if net != self.net and 'get_connections' in self.tasks:
+            dirty.add('get_connections')
+        self.net = net
+        return dirty
+
+    def rerun(self, names):
+        for name in sorted(names):
+            t = self.tasks[name]
+            self.host.rerun(t)
+            for task in t.provides:
+                if task not in RESULTS:
+                    continue
+                new = snapshot(self.host.record(task))
+                added, removed = diff(self.previous[task], new)
+                self.previous[task] = new
+                if added or removed:
+                    self.alert({'host': str(self.host), 'task': task, 'time': time.time(),
+                                'added': added, 'removed': removed})
+
+    def changed(self):
+        # Tasks affected by the queued inotify events. New directories along a watched path are
+        # watched before their task re-runs, so nothing written into them afterwards is missed.
+        dirty = set()
+        for path, mask in self.inotify.read():
+            if path is None:
+                dirty.update(n for n in self.tasks if self.tasks[n].watch)
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                if any(os.path.realpath(path).startswith(top + '/')
+                       for tops in self.trees.values() for top in tops):
+                    self._watch_tree(path)
+                for patterns in self.patterns.values():
+                    for p in patterns:
+                        if _is_prefix(path, _dir_parts(p)):
+                            self._watch_dirs(_dir_parts(p), path)
+            dirty |= self.affected(path, bool(mask & (IN_ISDIR | IN_DELETE_SELF | IN_MOVE_SELF)))
+        return dirty
+
+    def run(self):
+        self.setup()
+        status(colorful.white_on_black("{} watching {} paths".format(self.host, len(self.inotify.paths))))
+        last_poll = time.monotonic()
+        try:
+            while True:
+                timeout = max(0.0, last_poll + self.interval - time.monotonic())
+                readable, _, _ = select.select([self.inotify.fd], [], [], timeout)
+                dirty = set()
+                if readable:
+                    # Let a burst of writes (editors, package installs) settle before re-running.
+                    time.sleep(0.1)
+                    dirty |= self.changed()
+                if time.monotonic() - last_poll >= self.interval:
+                    last_poll = time.monotonic()
+                    dirty |= self.poll()
+                self.rerun(dirty)
+        finally:
+            self.inotify.close()
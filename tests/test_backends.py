@@ -0,0 +1,243 @@
+import hashlib
+import os
+import select
+import socket
+import stat
+import subprocess
+import tempfile
+import threading
+import unittest
+from contextlib import redirect_stderr
+from io import StringIO
+
+from blueteam.backends import SSHBackend, decode_address, parse_net_snapshot
+
+PASSWD = b'root:x:0:0:root:/root:/bin/sh\nalice:x:1000:1000::/home/alice:/bin/sh\n'
+
+
+def frame(data: bytes):
+    return b'%d\n' % len(data) + data
+
+
+def process(pid, uid, exe: bytes, stat: bytes, cmdline: bytes):
+    # As PROC_SNAPSHOT prints it, with cmdline's NULs already turned into \001.
+    return b'%d %s %d %d %d\n' % (pid, uid, len(exe), len(stat), len(cmdline)) + exe + stat + cmdline
+
+# Stand-ins for sudo -S -p '' on the remote host: one that reads the password line before
+# running the command, one that runs it straight away as with NOPASSWD or cached credentials.
+SUDO = {
+    'prompt': '#!/bin/sh\nIFS= read -r password\nshift 3\nexec "$@"\n',
+    'nopasswd': '#!/bin/sh\nshift 3\nexec "$@"\n',
+}
+
+
+class Channel:
+    def __init__(self, process):
+        self.process = process
+        self.timeout = None
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def recv(self, size):
+        fd = self.process.stdout.fileno()
+        if self.timeout is not None and not select.select([fd], [], [], self.timeout)[0]:
+            raise socket.timeout()
+        return os.read(fd, size)
+
+    def shutdown_write(self):
+        self.process.stdin.close()
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+
+class ChannelFile:
+    def __init__(self, channel):
+        self.channel = channel
+
+    def write(self, data):
+        self.channel.process.stdin.write(data.encode() if isinstance(data, str) else data)
+
+    def flush(self):
+        self.channel.process.stdin.flush()
+
+    def read(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.channel.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+
+class LocalClient:
+    """Runs exec_command locally, the way sshd would run it for paramiko."""
+
+    def __init__(self, path):
+        self.env = dict(os.environ, PATH=path + os.pathsep + os.environ['PATH'])
+
+    def exec_command(self, command):
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL, env=self.env)
+        channel = Channel(process)
+        return ChannelFile(channel), ChannelFile(channel), None
+
+
+def backend(path, sudo=None):
+    b = SSHBackend.__new__(SSHBackend)
+    b.host = 'localhost'
+    b.sudo = sudo
+    b.ssh = LocalClient(path)
+    b.uid_name_map = {}
+    b.agents = []
+    b.agents_started = 0
+    b.agent_ok = True
+    b.agent_lock = threading.Condition()
+    return b
+
+
+class SudoStdinTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        for name, script in SUDO.items():
+            os.makedirs(os.path.join(self.dir.name, name))
+            path = os.path.join(self.dir.name, name, 'sudo')
+            with open(path, 'w') as f:
+                f.write(script)
+            os.chmod(path, stat.S_IRWXU)
+        self.link = os.path.join(self.dir.name, 'link')
+        os.symlink('/etc/hosts', self.link)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def backends(self, agent: bool):
+        for name in SUDO:
+            b = backend(os.path.join(self.dir.name, name), sudo='hunter2')
+            b.agent_ok = agent
+            with self.subTest(sudo=name, agent=agent):
+                yield b
+            for a in b.agents:
+                a.close()
+
+    def test_agent(self):
+        for b in self.backends(agent=True):
+            self.assertEqual(b.getuid(), os.getuid())
+            self.assertTrue(b.agent_ok)
+
+    def test_real_paths(self):
+        for agent in (True, False):
+            for b in self.backends(agent):
+                self.assertEqual(b.real_paths([self.link, '/etc/hosts']),
+                                 [os.path.realpath('/etc/hosts')] * 2)
+                self.assertEqual(b.agent_ok, agent)
+
+    def test_hash_files(self):
+        expected = {}
+        for path in ('/etc/hostname', '/etc/hosts'):
+            with open(path, 'rb') as f:
+                expected[path] = hashlib.md5(f.read()).hexdigest()
+        for agent in (True, False):
+            for b in self.backends(agent):
+                self.assertEqual(b.hash_files(list(expected)), expected)
+
+
+class ProcessSnapshotTest(unittest.TestCase):
+    def processes(self, data: bytes):
+        b = backend('')
+        # One byte per chunk, so every field straddles a chunk boundary.
+        b.stream_command = lambda command, sep=None: (data[i:i + 1] for i in range(len(data)))
+        return dict(b.get_processes())
+
+    def test_crafted_fields(self):
+        data = frame(PASSWD) + b''.join([
+            process(1, b'0', b'/sbin/init', b'1 (init) S 0 1 1\n', b'/sbin/init\x01'),
+            process(42, b'1000', b'/tmp/evil\n\x1e7 0 1 1 1\n',
+                    b'42 (x) 1 2 (y\n\x1e) S 1 42 42\n', b'evil\x01--name\n\x1e\x01\x01x\x01'),
+            process(43, b'-', b'', b'43 (kworker/0:1) I 2 0 0\n', b''),
+        ])
+        processes = self.processes(data)
+        self.assertEqual(sorted(processes), [1, 42, 43])
+        evil = processes[42]
+        self.assertEqual(evil['exe'], '/tmp/evil\n\x1e7 0 1 1 1\n')
+        self.assertEqual(evil['name'], 'x) 1 2 (y\n\x1e')
+        self.assertEqual(evil['ppid'], 1)
+        self.assertEqual(evil['cmdline'], 'evil --name\n\x1e  x')
+        self.assertEqual(evil['username'], 'alice')
+        self.assertEqual((processes[1]['username'], processes[1]['name']), ('root', 'init'))
+        self.assertEqual((processes[43]['username'], processes[43]['ppid']), (None, 2))
+
+    def test_unparsable_stat(self):
+        with redirect_stderr(StringIO()) as err:
+            processes = self.processes(frame(b'') + process(7, b'0', b'/bin/x', b'garbage', b'x\x01'))
+        self.assertEqual((processes[7]['name'], processes[7]['ppid']), ('?', None))
+        self.assertIn('/proc/7/stat', err.getvalue())
+
+    def test_truncated(self):
+        data = frame(PASSWD) + process(1, b'0', b'/sbin/init', b'1 (init) S 0 1 1\n', b'/sbin/init\x01')
+        for end in (len(data) - 1, len(frame(PASSWD)) + 2, len(PASSWD), 3):
+            with self.subTest(end=end), self.assertRaises(ValueError):
+                self.processes(data[:end])
+        with self.assertRaises(ValueError):
+            self.processes(frame(b'') + b'1 0 x 1 1\nabc')
+
+
+# Lines as the kernel prints them: each address is four host-endian (here little-endian) words.
+NET = """@tcp
+  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 0100007F:0CEA 00000000:0000 0A 00000000:00000000 00:00000000 00000000   106        0 20811 1 0000000000000000 100 0 0 10 0
+@tcp6
+  sl  local_address                         remote_address                        st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 00000000000000000000000000000000:0016 00000000000000000000000000000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 17710 1 0000000000000000 100 0 0 10 0
+   1: 0000000000000000FFFF00000A01A8C0:0016 0000000000000000FFFF00000500000A:C822 01 00000000:00000000 02:000A1B2C 00000000     0        0 31337 2 0000000000000000 20 4 29 10 -1
+   2: B80D0120000000000000000001000000:01BB B80D012000000000000000002A000000:D431 06 00000000:00000000 03:00001770 00000000     0        0 0 3 0000000000000000
+@udp6
+   sl  local_address                         remote_address                        st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops
+  123: 00000000000000000000000001000000:0035 00000000000000000000000000000000:0000 07 00000000:00000000 00:00000000 00000000   101        0 18204 2 0000000000000000 0
+@fd
+/proc/812/fd socket:[17710]
+/proc/812/fd socket:[20811]
+/proc/4242/fd socket:[31337]
+/proc/905/fd socket:[18204]
+@comm
+/proc/812/comm:sshd
+/proc/4242/comm:sshd
+/proc/905/comm:systemd-resolve
+"""
+
+
+class NetSnapshotTest(unittest.TestCase):
+    def test_decode_address(self):
+        self.assertEqual(decode_address('0100007F:0CEA'), ('127.0.0.1', 3306))
+        self.assertEqual(decode_address('0000000000000000FFFF00000A01A8C0:0016'), ('::ffff:192.168.1.10', 22))
+        self.assertEqual(decode_address('B80D0120000000000000000001000000:01BB'), ('2001:db8::1', 443))
+
+    def test_parse(self):
+        # Same fields and formatting as LocalBackend.get_connections gets from psutil.
+        self.assertEqual(parse_net_snapshot(NET.splitlines()), [
+            {'proto': 'tcp', 'laddr': '127.0.0.1:3306', 'raddr': '', 'status': 'LISTEN', 'pid': 812,
+             'program': 'sshd'},
+            {'proto': 'tcp6', 'laddr': ':::22', 'raddr': '', 'status': 'LISTEN', 'pid': 812, 'program': 'sshd'},
+            {'proto': 'tcp6', 'laddr': '::ffff:192.168.1.10:22', 'raddr': '::ffff:10.0.0.5:51234',
+             'status': 'ESTABLISHED', 'pid': 4242, 'program': 'sshd'},
+            {'proto': 'tcp6', 'laddr': '2001:db8::1:443', 'raddr': '2001:db8::2a:54321', 'status': 'TIME_WAIT',
+             'pid': None, 'program': None},
+            {'proto': 'udp6', 'laddr': '::1:53', 'raddr': '', 'status': 'NONE', 'pid': 905,
+             'program': 'systemd-resolve'},
+        ])
+
+    def test_names_given(self):
+        names = {812: 'sshd'}
+        connections = parse_net_snapshot([line for line in NET.splitlines() if not line.startswith('/proc/')
+                                          or '/fd ' in line], names)
+        self.assertEqual([c['program'] for c in connections], ['sshd', 'sshd', None, None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
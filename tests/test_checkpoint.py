@@ -0,0 +1,41 @@
+import os
+import tempfile
+import unittest
+
+from blueteam.checkpoint import Checkpoint
+from blueteam.fake import FakeBackend, SystemImage
+from blueteam.modules import Host
+from blueteam.proctable import ProcessTable
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.image = SystemImage(processes=50, dpkg=300, files=10)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def host(self, resume: bool):
+        return Host(FakeBackend(self.image, host='h1'), file_sentry=True,
+                    checkpoint=Checkpoint(self.dir.name, resume))
+
+    def test_resume(self):
+        first = self.host(resume=False)
+        first.run_all()
+        self.assertTrue(all(name.endswith('.json') for name in os.listdir(os.path.join(self.dir.name, 'h1'))))
+        second = self.host(resume=True)
+        self.assertEqual(second.restore(), [])
+        self.assertIsInstance(second.processes, ProcessTable)
+        self.assertIsInstance(second.files, set)
+        self.assertEqual(second.records(), first.records())
+
+    def test_pickle_ignored(self):
+        os.makedirs(os.path.join(self.dir.name, 'h1'))
+        with open(os.path.join(self.dir.name, 'h1', 'get_processes.pickle'), 'wb') as f:
+            f.write(b"cos\nsystem\n(S'touch pwned'\ntR.")
+        self.assertEqual(Checkpoint(self.dir.name, resume=True).load('h1'), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+
+from blueteam.dpkg import DpkgIndex, IndexCache
+from blueteam.fake import FakeBackend, SystemImage
+
+# What os.readlink() and os.listdir() return for the name b'/usr/bin/bad\xffx'.
+BAD = os.fsdecode(b'/usr/bin/bad\xffx')
+
+
+class DpkgIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.image = SystemImage(processes=10, dpkg=200, files=5)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def index(self):
+        return DpkgIndex(os.path.join(self.dir.name, 'index.sqlite')).refresh(FakeBackend(self.image))
+
+    def test_non_utf8_lookup(self):
+        index = self.index()
+        self.assertNotIn(BAD, index)
+        self.assertIsNone(index.get(BAD))
+
+    def test_non_utf8_owned(self):
+        self.image.files['/var/lib/dpkg/info/pkg0:amd64.list'].append(BAD)
+        index = self.index()
+        self.assertIn(BAD, index)
+        self.assertEqual(index[BAD], 'pkg0')
+        self.assertNotIn(os.fsdecode(b'/usr/bin/bad\xfex'), index)
+
+
+class IndexCacheTest(unittest.TestCase):
+    def test_evicted_while_in_use(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = IndexCache(directory, max_entries=1)
+            first, second = SystemImage(processes=10, dpkg=200, seed=1), SystemImage(processes=10, dpkg=300, seed=2)
+            index = cache.get(FakeBackend(first, host='a'))
+            # Publishing b's index evicts a's file before a has queried its index.
+            cache.get(FakeBackend(second, host='b'))
+            size = len(index)
+            self.assertGreater(size, 0)
+            # A host identical to a must rebuild, not be served an empty index.
+            self.assertEqual(len(cache.get(FakeBackend(first, host='c'))), size)
+            self.assertEqual(cache.stats(), {'hits': 0, 'misses': 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
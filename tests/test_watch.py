@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+
+from blueteam.watch import Watcher
+
+
+class Task:
+    __name__ = 'keys'
+    provides = ()
+
+    def __init__(self, watch):
+        self.watch = watch
+
+
+class Host:
+    def __init__(self, *tasks):
+        self._tasks = tasks
+
+
+class WatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.home = os.path.join(self.dir.name, 'home')
+        os.makedirs(os.path.join(self.home, 'alice'))
+        self.watcher = Watcher(Host(Task([self.home + '/*/.ssh/authorized_keys'])), alert=None)
+        self.watcher.setup()
+
+    def tearDown(self):
+        self.watcher.inotify.close()
+        self.dir.cleanup()
+
+    def write_key(self, user):
+        with open(os.path.join(self.home, user, '.ssh', 'authorized_keys'), 'w') as f:
+            f.write('ssh-ed25519 AAAA\n')
+
+    def test_new_ssh_dir(self):
+        self.assertIn(os.path.join(self.home, 'alice'), self.watcher.inotify.paths.values())
+        os.mkdir(os.path.join(self.home, 'alice', '.ssh'))
+        self.assertEqual(self.watcher.changed(), {'keys'})
+        self.write_key('alice')
+        self.assertEqual(self.watcher.changed(), {'keys'})
+
+    def test_new_home(self):
+        # Created in one go, before the watcher has seen the user's home directory.
+        os.makedirs(os.path.join(self.home, 'bob', '.ssh'))
+        self.assertEqual(self.watcher.changed(), {'keys'})
+        self.write_key('bob')
+        self.assertEqual(self.watcher.changed(), {'keys'})
+
+    def test_unrelated_file(self):
+        open(os.path.join(self.home, 'notes'), 'w').close()
+        self.assertEqual(self.watcher.changed(), set())
+
+
+if __name__ == '__main__':
+    unittest.main()